@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Offline load test of the bot: replays a stream of comments through
+bot.main() with a fake reddit and a fake genius client and reports
+throughput, reply latency and database queries.
+
+Usage:
+    python benchmarks/load_test.py --suite
+    python benchmarks/load_test.py --hit-ratio 0.9 --comments 2000
+    python benchmarks/load_test.py --songs lyrics/ --genius-latency 1.5
+
+Songs come from --songs (a directory of songs json files, used as
+templates) or are made up. A share of the requests, --hit-ratio, asks for
+songs already in the song store; every other request asks for a song only
+the fake genius client knows. Comment ids go to a sqlite file in the work
+directory, unless DB_BACKEND is set.
+"""
+import os
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import itertools
+import tempfile
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+
+# Titles are spelled out from these words, so that titles of different
+# songs don't look like near-miss spellings of each other.
+WORDS = ('money', 'night', 'street', 'dream', 'crown', 'river', 'ghost',
+         'paper', 'flame', 'echo', 'stone', 'cloud', 'mirror', 'engine')
+
+
+def make_title(song_id):
+    """Spells a song id out as a title."""
+    words = []
+    while True:
+        song_id, digit = divmod(song_id, len(WORDS))
+        words.append(WORDS[digit])
+        if not song_id:
+            return ' '.join(words).title()
+
+
+def make_song(song_id, template=None):
+    """Returns a songs json, made up or copied from a recorded one."""
+    if template is not None:
+        data = copy.deepcopy(template)
+    else:
+        verse = '\n'.join(f"bar {i} of a made up verse" for i in range(16))
+        data = {
+            'lyrics': (f"[Intro]\nyeah\n\n[Verse 1]\n{verse}\n\n[Chorus]\n"
+                       f"hook line\nhook line\n\n[Verse 2]\n{verse}\n\n"
+                       f"[Outro]\nyeah"),
+            'featured_artists': [{'name': 'Guest'}],
+            'producer_artists': [{'name': 'Producer'}],
+            'writer_artists': [{'name': 'Writer'}],
+            'album': {'name': 'Album'},
+            'release_date_for_display': 'May 26, 2000',
+            'description': {'plain': 'A made up song. ' * 50},
+            'custom_performances': [{'label': 'Mixed by',
+                                     'artists': [{'name': 'Engineer'}]}],
+            'recording_location': 'Studio',
+            'song_relationships': [{'type': 'samples',
+                                    'songs': [{'full_title': 'Old song by Someone'}]}],
+        }
+    data['id'] = song_id
+    data['title'] = make_title(song_id)
+    data['primary_artist'] = {'name': f"Artist {song_id % 25}"}
+    return data
+
+
+def make_comments(hit_songs, make_song, count, command_share, hit_ratio, seed):
+    """
+    Builds the comments stream, as json records, and returns it with the
+    songs missing from the store, made by make_song(song_id) as needed.
+    """
+    rng = random.Random(seed)
+    options = ['lyrics', 'lyrics, verse1 chorus, 2 8', 'short info',
+               'long info', 'relations']
+    miss_ids = itertools.count(1001)
+    miss_songs = []
+    records = []
+    for i in range(count):
+        if rng.random() >= command_share:
+            body = 'this album is a classic ' * rng.choice([2, 20, 100])
+        else:
+            if rng.random() < hit_ratio:
+                song = rng.choice(hit_songs)
+            else:
+                song = make_song(next(miss_ids))
+                miss_songs.append(song)
+            body = (f"geniusbot, {song['primary_artist']['name']}, "
+                    f"{song['title']}, {rng.choice(options)}")
+        records.append({'id': f"lt{seed}x{i}", 'body': body})
+    return records, miss_songs
+
+
+def percentile(values, share):
+    """Returns the value below which share of the values fall."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def run(args):
+    """Runs one load test in this process and returns its results."""
+    templates = []
+    if args.songs:
+        for filename in sorted(os.listdir(args.songs)):
+            if filename.endswith('.json'):
+                with open(os.path.join(args.songs, filename)) as f:
+                    templates.append(json.load(f))
+
+    def song(song_id):
+        template = templates[song_id % len(templates)] if templates else None
+        return make_song(song_id, template)
+
+    hit_songs = [song(i) for i in range(1, 201)]
+    records, miss_songs = make_comments(hit_songs, song, args.comments,
+                                        args.command_share, args.hit_ratio,
+                                        args.seed)
+
+    # The bot reads its settings when it is imported.
+    workdir = tempfile.mkdtemp(prefix='rapgenius-load-')
+    os.environ['SONG_DB'] = os.path.join(workdir, 'songs.db')
+    os.environ.setdefault('DB_BACKEND', 'sqlite')
+    os.environ.setdefault('REPLY_RATE', '1000000')
+    os.environ.setdefault('REPLY_BURST', '1000000')
+    os.chdir(workdir)
+
+    import sections
+    import songstore
+    store = songstore.SongStore(os.environ['SONG_DB'])
+    for data in hit_songs:
+        store.put(*songstore.canonical_key(data), sections.add_index(data))
+
+    import fakes
+    import bot
+    import database
+
+    queries = [0]
+    execute_sql = database.db.execute_sql
+
+    def counting_execute_sql(*a, **kw):
+        queries[0] += 1
+        return execute_sql(*a, **kw)
+
+    database.db.execute_sql = counting_execute_sql
+
+    comments = [fakes.FakeComment(r['id'], r['body'], reply_latency=args.reply_latency)
+                for r in records]
+    reddit = fakes.FakeReddit(comments)
+    genius = fakes.FakeGenius(miss_songs, latency=args.genius_latency)
+
+    start = time.monotonic()
+    bot.main(reddit=reddit, genius=genius)
+    elapsed = time.monotonic() - start
+
+    latencies = [c.replied_at - c.read_at for c in comments if c.replied_at]
+    return {
+        'hit_ratio': args.hit_ratio,
+        'comments': len(comments),
+        'replies': len(latencies),
+        'seconds': elapsed,
+        'comments_per_s': len(comments) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'db_queries': queries[0],
+        'genius_searches': genius.searches,
+    }
+
+
+def print_table(results):
+    """Prints the results of several runs."""
+    print(f"{'hit ratio':>9} {'comments':>8} {'replies':>7} {'comments/s':>10} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'db queries':>10} {'searches':>8}")
+    for r in results:
+        print(f"{r['hit_ratio']:>9.2f} {r['comments']:>8} {r['replies']:>7} "
+              f"{r['comments_per_s']:>10.1f} {r['p50_ms']:>8.1f} "
+              f"{r['p99_ms']:>8.1f} {r['db_queries']:>10} "
+              f"{r['genius_searches']:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--songs', help='directory of recorded songs json files')
+    parser.add_argument('--comments', type=int, default=2000)
+    parser.add_argument('--command-share', type=float, default=0.1,
+                        help='share of comments addressed to the bot')
+    parser.add_argument('--hit-ratio', type=float, default=0.9,
+                        help='share of requests for songs already stored')
+    parser.add_argument('--genius-latency', type=float, default=0.5,
+                        help='seconds each fake Genius.com search takes')
+    parser.add_argument('--reply-latency', type=float, default=0.05,
+                        help='seconds each fake reply takes')
+    parser.add_argument('--seed', type=int, default=random.randrange(10 ** 6))
+    parser.add_argument('--suite', action='store_true',
+                        help='run every hit ratio in its own process')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as json')
+    args = parser.parse_args(argv)
+
+    if not args.suite:
+        result = run(args)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print_table([result])
+        return
+
+    results = []
+    passthrough = [a for a in (argv if argv is not None else sys.argv[1:])
+                   if a != '--suite']
+    for hit_ratio in (1.0, 0.9, 0.5, 0.0):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *passthrough,
+             '--hit-ratio', str(hit_ratio), '--json'],
+            check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    print_table(results)
+
+
+if __name__ == "__main__":
+    main()
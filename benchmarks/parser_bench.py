@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of comment parsing: the comma splitting parser the
+bot used to run on every comment against the trigger check plus the
+compiled command grammar in commands.py.
+
+Usage:
+    python benchmarks/parser_bench.py [--corpus comments.jsonl] [--rounds 20]
+
+The corpus has one json object per line with the comment text under
+"body". Without a corpus, a synthetic one of mostly long ordinary
+comments with a few bot commands mixed in is used.
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import commands
+
+
+class Comment:
+    """Stand in for a praw comment."""
+
+    def __init__(self, body):
+        self.body = body
+
+
+def legacy_parse(comment):
+    """The parsing the bot did before commands.py, minus the database lookup."""
+    comment_list = comment.body.split(',')
+    if comment_list[0].strip().lower() != 'geniusbot':
+        return None
+    try:
+        artist_name = comment_list[1].strip().lower()
+        song_name = comment_list[2].strip().lower()
+        option = comment_list[3].strip().lower()
+        option_list = ['lyrics', 'short info', 'long info', 'relations']
+        if option not in option_list:
+            return None
+        lyrics_suboptions = ''
+        beg = ''
+        end = ''
+        try:
+            if option == 'lyrics':
+                lyrics_suboptions = comment_list[4].strip().lower().split()
+                suboptions_list = ['intro', 'outro', 'verse1', 'verse2',
+                                   'verse3', 'verse4', 'verse5', 'verse6',
+                                   'verse7', 'verse8', 'verse9', 'verse10',
+                                   'verse11', 'verse12', 'verse13',
+                                   'interlude', 'bridge', 'chorus', 'hook',
+                                   'pre-chorus', 'break', 'refrain',
+                                   'post-chorus', 'collision']
+                for suboption in lyrics_suboptions:
+                    if suboption not in suboptions_list:
+                        return None
+                if comment_list[5]:
+                    bar_suboptions = comment_list[5].split()
+                    if bar_suboptions[0]:
+                        beg = bar_suboptions[0]
+                    if bar_suboptions[1]:
+                        end = bar_suboptions[1]
+        except IndexError:
+            pass
+    except IndexError:
+        return None
+    return artist_name, song_name, option, lyrics_suboptions, beg, end
+
+
+def new_parse(comment):
+    """The trigger check followed by the command grammar."""
+    if not commands.is_trigger(comment.body):
+        return None
+    return commands.parse(comment)
+
+
+def synthetic_corpus(size=5000, command_share=0.05):
+    """Builds comments that look like a busy hip hop subreddit."""
+    rng = random.Random(7)
+    words = ('the verse on this, track is crazy, honestly the beat '
+             'switch, goes hard, album of the year, no skips').split()
+    command_list = [
+        'geniusbot, eminem, lose yourself, lyrics',
+        'geniusbot, eminem, rap god, lyrics, verse1 chorus, 2 6',
+        'geniusbot, kendrick lamar, alright, short info',
+        'geniusbot, 2pac, changes, relations',
+        'geniusbot, nas, ny state of mind, long info',
+    ]
+    corpus = []
+    for _ in range(size):
+        if rng.random() < command_share:
+            corpus.append(rng.choice(command_list))
+        else:
+            length = rng.choice([20, 80, 400, 1500])
+            corpus.append(' '.join(rng.choice(words) for _ in range(length)))
+    return corpus
+
+
+def bench(func, comments, rounds):
+    """Returns the comments per second func parses."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for comment in comments:
+            func(comment)
+    return len(comments) * rounds / (time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--corpus', help='json lines file of comments')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    # The parsers log invalid commands, which would dominate the timings.
+    logging.disable(logging.CRITICAL)
+
+    if args.corpus:
+        with open(args.corpus) as f:
+            bodies = [json.loads(line)['body'] for line in f if line.strip()]
+    else:
+        bodies = synthetic_corpus()
+    comments = [Comment(body) for body in bodies]
+
+    legacy = bench(legacy_parse, comments, args.rounds)
+    new = bench(new_parse, comments, args.rounds)
+    print(f"corpus: {len(comments)} comments, "
+          f"{sum(map(len, bodies)) / len(bodies):.0f} chars on average")
+    print(f"legacy split parser: {legacy:12.0f} comments/s")
+    print(f"trigger + grammar:   {new:12.0f} comments/s ({new / legacy:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
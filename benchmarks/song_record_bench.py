@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of loading a song: parsing the whole Genius.com json
+with json.loads against unpacking the slim SongRecord the replies are
+rendered from, in load time, memory held and bytes stored per song.
+
+Usage:
+    python benchmarks/song_record_bench.py [--songs lyrics/] [--rounds 20]
+
+Songs come from --songs, a directory of songs json files as saved from
+Genius.com, or are made up to the shape of a full Genius.com response.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import cache
+import sections
+import songrecord
+
+
+def make_artist(rng, name):
+    """Returns an artist the way Genius.com nests them in a song."""
+    return {
+        'api_path': f"/artists/{rng.randrange(10 ** 6)}",
+        'header_image_url': f"https://images.genius.com/{rng.randrange(10 ** 9):x}.jpg",
+        'id': rng.randrange(10 ** 6),
+        'image_url': f"https://images.genius.com/{rng.randrange(10 ** 9):x}.jpg",
+        'is_meme_verified': False,
+        'is_verified': rng.random() < 0.5,
+        'name': name,
+        'url': f"https://genius.com/artists/{name.replace(' ', '-')}",
+        'iq': rng.randrange(10 ** 5),
+    }
+
+
+def make_dom(rng, words, depth=3):
+    """Returns a description DOM tree like the one Genius.com sends."""
+    if depth == 0:
+        return ' '.join(rng.choice(words) for _ in range(12))
+    return {'tag': rng.choice(['p', 'a', 'em', 'strong']),
+            'attributes': {'href': 'https://genius.com/'} if depth == 2 else {},
+            'children': [make_dom(rng, words, depth - 1) for _ in range(4)]}
+
+
+def make_song(song_id, rng):
+    """Returns a made up song shaped like a full Genius.com response."""
+    words = ('money night street dream crown river ghost paper flame echo '
+             'stone cloud mirror engine').split()
+    verse = '\n'.join(' '.join(rng.choice(words) for _ in range(8))
+                      for _ in range(16))
+    lyrics = '\n\n'.join(f"[{name}]\n{verse}" for name in
+                         ('Intro', 'Verse 1', 'Chorus', 'Verse 2', 'Chorus',
+                          'Verse 3', 'Outro'))
+    return {
+        'id': song_id,
+        'title': f"Song {song_id}",
+        'full_title': f"Song {song_id} by Artist",
+        'url': f"https://genius.com/song-{song_id}-lyrics",
+        'lyrics': lyrics,
+        'primary_artist': make_artist(rng, 'Artist'),
+        'featured_artists': [make_artist(rng, f"Guest {i}") for i in range(2)],
+        'producer_artists': [make_artist(rng, f"Producer {i}") for i in range(3)],
+        'writer_artists': [make_artist(rng, f"Writer {i}") for i in range(4)],
+        'album': {'id': 1, 'name': 'Album', 'url': 'https://genius.com/albums/a',
+                  'cover_art_url': 'https://images.genius.com/a.jpg',
+                  'artist': make_artist(rng, 'Artist')},
+        'release_date': '2000-05-26',
+        'release_date_for_display': 'May 26, 2000',
+        'recording_location': 'Studio',
+        'description': {'dom': make_dom(rng, words),
+                        'plain': ' '.join(rng.choice(words) for _ in range(300))},
+        'custom_performances': [{'label': label,
+                                 'artists': [make_artist(rng, f"{label} {i}")
+                                             for i in range(2)]}
+                                for label in ('Mixed by', 'Mastered by', 'Label')],
+        'song_relationships': [{'relationship_type': kind, 'type': kind,
+                                'songs': [{'full_title': f"Other {i} by Someone",
+                                           'id': i, 'url': 'https://genius.com/x',
+                                           'primary_artist': make_artist(rng, 'Someone')}
+                                          for i in range(3)]}
+                               for kind in ('samples', 'sampled_in', 'interpolates',
+                                            'cover_of', 'remix_of', 'live_version_of')],
+        'media': [{'provider': p, 'type': 'audio', 'url': f"https://{p}.com/x"}
+                  for p in ('youtube', 'spotify', 'soundcloud')],
+        'stats': {'accepted_annotations': 12, 'contributors': 40, 'hot': False,
+                  'iq_earners': 30, 'transcribers': 4, 'pageviews': 1234567},
+        'current_user_metadata': {'permissions': ['see_pageviews', 'create_comment'],
+                                  'excluded_permissions': ['edit', 'moderate'] * 10,
+                                  'interactions': {'pyongs': False, 'following': False}},
+        'description_annotation': {'annotations': [{'body': {'dom': make_dom(rng, words)},
+                                                    'votes_total': 10}]},
+    }
+
+
+def measure(load, blobs, rounds):
+    """Returns the seconds load takes per song and the bytes per song its results hold."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for blob in blobs:
+            load(blob)
+    seconds = (time.perf_counter() - start) / (rounds * len(blobs))
+
+    tracemalloc.start()
+    held = [load(blob) for blob in blobs]
+    memory = tracemalloc.get_traced_memory()[0] / len(blobs)
+    tracemalloc.stop()
+    return seconds, memory, cache.sizeof(held[0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--songs', help='directory of songs json files')
+    parser.add_argument('--count', type=int, default=200,
+                        help='made up songs, without --songs')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    if args.songs:
+        songs = []
+        for filename in sorted(os.listdir(args.songs)):
+            if filename.endswith('.json'):
+                with open(os.path.join(args.songs, filename)) as f:
+                    songs.append(json.load(f))
+    else:
+        rng = random.Random(7)
+        songs = [make_song(i, rng) for i in range(args.count)]
+
+    texts = [json.dumps(sections.add_index(song)) for song in songs]
+    packed = [songrecord.SongRecord.from_dict(song).pack() for song in songs]
+
+    results = [
+        ('json.loads', sum(map(len, texts)) / len(texts),
+         *measure(json.loads, texts, args.rounds)),
+        ('SongRecord.unpack', sum(map(len, packed)) / len(packed),
+         *measure(songrecord.SongRecord.unpack, packed, args.rounds)),
+    ]
+    print(f"{len(songs)} songs")
+    print(f"{'':18} {'stored B':>9} {'load us':>8} {'traced B':>9} {'sizeof B':>9}")
+    for name, stored, seconds, memory, size in results:
+        print(f"{name:18} {stored:>9.0f} {seconds * 1e6:>8.1f} "
+              f"{memory:>9.0f} {size:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Module to compute retry delays that grow exponentially, with
+jitter so restarts don't all hit reddit at the same moment.
+"""
+import random
+
+
+class Backoff:
+    """Delays of up to base * 2 ** attempt seconds, capped at cap seconds."""
+
+    def __init__(self, base, cap):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def delay(self, attempt):
+        """Returns the delay before retry number attempt, counted from 0."""
+        ceiling = min(self.cap, self.base * 2 ** attempt)
+        # Full jitter, but never retry sooner than base seconds.
+        return max(self.base, random.uniform(0, ceiling))
+
+    def next_delay(self):
+        """Returns the delay before the next retry and counts the attempt."""
+        self.attempt += 1
+        return self.delay(self.attempt - 1)
+
+    def reset(self):
+        """Starts over from the base delay after a success."""
+        self.attempt = 0
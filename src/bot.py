@@ -4,35 +4,258 @@ Module to stream reddit comments and reply with song
 lyrics, metadata when triggered.
 """
 import os
-import re
 import time
-import json
-import shutil
 import logging
+import sys
+import sqlite3
+import functools
+import itertools
+import threading
+import subprocess
 
 import praw
-import lyricsgenius
 import praw.exceptions
 import prawcore.exceptions
 
+import backoff
+import cache
+import checkpoint
+import commands
 import database as db
-
-
-def main():
+import geniusclient
+import metrics
+import pipeline
+import ratelimit
+import refresher
+import sections
+import singleflight
+import songstore
+import workqueue
+import writebehind
+
+# Subreddits to stream, joined by '+'.
+SUBREDDITS = os.environ.get('SUBREDDITS',
+                            'Eminem+Tupac+hiphop101+hiphop+hiphopheads')
+
+# The subreddits are split between WORKER_COUNT workers, this process is
+# worker WORKER_INDEX. With WORKER_COUNT above 1 and no WORKER_INDEX, the
+# process starts all the workers itself, worker i serving its metrics on
+# METRICS_PORT + i and writing them to METRICS_FILE.i.
+WORKER_COUNT = int(os.environ.get('WORKER_COUNT', 1))
+WORKER_INDEX = int(os.environ.get('WORKER_INDEX', 0))
+
+# Whether each comment is claimed in the database before it is handled,
+# so workers sharing the database never reply to the same comment.
+CLAIM_COMMENTS = os.environ.get(
+    'CLAIM_COMMENTS', '1' if WORKER_COUNT > 1 else '0') == '1'
+
+# Most replies per second sent across the whole bot, and how many
+# replies may go out back to back after a quiet spell. Reddit's quota
+# and RATELIMIT errors slow replies down further when they need to.
+REPLY_RATE = float(os.environ.get('REPLY_RATE', 1))
+REPLY_BURST = int(os.environ.get('REPLY_BURST', 3))
+
+# Api requests of reddit's quota left for the rest of the bot.
+QUOTA_RESERVE = int(os.environ.get('QUOTA_RESERVE', 10))
+
+# Number of threads fetching songs from Genius.com.
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', 4))
+
+# Seconds to wait for Genius.com to answer a request, and how many times
+# a request that failed for a passing reason is tried again.
+GENIUS_TIMEOUT = float(os.environ.get('GENIUS_TIMEOUT', 10))
+GENIUS_RETRIES = int(os.environ.get('GENIUS_RETRIES', 3))
+
+# With GENIUS_CONCURRENCY above 0, songs are fetched on an event loop,
+# the details call and the lyrics scrape of a song at the same time, with
+# at most GENIUS_CONCURRENCY songs in flight. Each fetch worker waits for
+# its song, so there are at least GENIUS_CONCURRENCY fetch workers.
+GENIUS_CONCURRENCY = int(os.environ.get('GENIUS_CONCURRENCY', 0))
+
+# Maximum number of items waiting between two pipeline stages.
+QUEUE_SIZE = int(os.environ.get('QUEUE_SIZE', 100))
+
+# Number of comment ids remembered to skip the database lookup.
+SEEN_CACHE_SIZE = int(os.environ.get('SEEN_CACHE_SIZE', 50000))
+
+# Replied comment ids are written in batches of FLUSH_SIZE ids, or
+# after FLUSH_INTERVAL seconds, whichever comes first.
+FLUSH_SIZE = int(os.environ.get('FLUSH_SIZE', 20))
+FLUSH_INTERVAL = float(os.environ.get('FLUSH_INTERVAL', 5))
+
+# How alike (0.0 to 1.0, by edits per letter) a misspelled artist or song
+# name must be to a stored one to be checked against Genius.com with a
+# single search instead of fetched in full.
+FUZZY_THRESHOLD = float(os.environ.get('FUZZY_THRESHOLD', 0.9))
+
+# Memory in bytes used to keep parsed songs around between replies.
+SONG_CACHE_BYTES = int(os.environ.get('SONG_CACHE_BYTES', 64 * 1024 * 1024))
+
+# Number of unresolvable song requests remembered, and for how many seconds.
+MISS_CACHE_SIZE = int(os.environ.get('MISS_CACHE_SIZE', 10000))
+MISS_CACHE_TTL = float(os.environ.get('MISS_CACHE_TTL', 6 * 60 * 60))
+
+# Number of rendered replies kept for songs that are asked for again.
+REPLY_CACHE_SIZE = int(os.environ.get('REPLY_CACHE_SIZE', 2000))
+
+# File holding the newest comment read, and how often it is rewritten.
+CHECKPOINT_FILE = os.environ.get(
+    'CHECKPOINT_FILE',
+    f"checkpoint.{WORKER_INDEX}.json" if WORKER_COUNT > 1 else 'checkpoint.json')
+CHECKPOINT_INTERVAL = float(os.environ.get('CHECKPOINT_INTERVAL', 10))
+
+# After a restart, comments down to BACKFILL_MARGIN seconds before the
+# checkpoint are read again, at most BACKFILL_LIMIT of them.
+BACKFILL_MARGIN = float(os.environ.get('BACKFILL_MARGIN', 120))
+BACKFILL_LIMIT = int(os.environ.get('BACKFILL_LIMIT', 1000))
+
+# Comment ids older than RETENTION_DAYS are deleted every
+# RETENTION_INTERVAL seconds, RETENTION_BATCH ids at a time. Reddit
+# archives threads after six months, so older comments can't be replied
+# to anyway.
+RETENTION_DAYS = float(os.environ.get('RETENTION_DAYS', 190))
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 60 * 60))
+RETENTION_BATCH = int(os.environ.get('RETENTION_BATCH', 1000))
+
+# Sqlite file holding the parsed requests until they are replied.
+QUEUE_DB = os.environ.get(
+    'QUEUE_DB', f"queue.{WORKER_INDEX}.db" if WORKER_COUNT > 1 else 'queue.db')
+
+# Number of times a request is tried before giving up on it.
+REPLY_ATTEMPTS = int(os.environ.get('REPLY_ATTEMPTS', 5))
+
+# Seconds between looks at an empty queue.
+QUEUE_POLL = float(os.environ.get('QUEUE_POLL', 1))
+
+# Seconds replied and failed requests are kept in the queue.
+QUEUE_RETENTION = float(os.environ.get('QUEUE_RETENTION', 24 * 60 * 60))
+
+# Songs fetched more than SONG_TTL seconds ago are still served, and
+# fetched again in the background, at most REFRESH_RATE songs per second.
+SONG_TTL = float(os.environ.get('SONG_TTL', 7 * 24 * 60 * 60))
+REFRESH_RATE = float(os.environ.get('REFRESH_RATE', 0.05))
+
+# Sqlite file holding every fetched song.
+SONG_DB = os.environ.get('SONG_DB', 'songs.db')
+
+# The songs in SONG_DB are kept under SONG_STORE_BYTES, compressed, by
+# evicting the least recently requested ones every SONG_STORE_INTERVAL
+# seconds, SONG_STORE_BATCH songs at a time. 0 keeps every song.
+SONG_STORE_BYTES = int(os.environ.get('SONG_STORE_BYTES', 512 * 1024 * 1024))
+SONG_STORE_INTERVAL = float(os.environ.get('SONG_STORE_INTERVAL', 60))
+SONG_STORE_BATCH = int(os.environ.get('SONG_STORE_BATCH', 200))
+
+# Newest comment read from the stream.
+_checkpoint = checkpoint.Checkpoint(CHECKPOINT_FILE, CHECKPOINT_INTERVAL)
+
+# Errors of the comment ids database and of the work queue.
+STORAGE_ERRORS = (db.DatabaseError, sqlite3.Error)
+
+# Set when an ingest stage failed on storage, the stream then stops and
+# run() restarts it from the checkpoint.
+_ingest_failed = threading.Event()
+
+# Comment id -> whether the bot has replied to it. Without claims this
+# process is the only one writing comment ids, so a cached False stays
+# valid until add_entry. With claims only True is trusted, the database
+# has the final say.
+_seen_comments = cache.LRUCache(SEEN_CACHE_SIZE)
+
+# Every fetched song, keyed by artist and song name.
+_song_store = songstore.SongStore(SONG_DB, FUZZY_THRESHOLD)
+
+# Song records, reloaded when a song is stored again.
+_song_cache = cache.SongCache(SONG_CACHE_BYTES)
+
+# Rendered replies, keyed by song, song version, option and suboptions.
+_reply_cache = cache.LRUCache(REPLY_CACHE_SIZE)
+
+# Genius.com searches in flight, keyed by artist and song.
+_genius_flight = singleflight.SingleFlight()
+
+# Stored songs waiting to be fetched again.
+_refresher = refresher.Refresher(REFRESH_RATE)
+
+# Artist and song keys Genius.com couldn't find.
+_missed_songs = cache.TTLCache(MISS_CACHE_SIZE, MISS_CACHE_TTL)
+
+# Parsed requests waiting for a reply.
+_work_queue = workqueue.WorkQueue(QUEUE_DB, REPLY_ATTEMPTS)
+
+# Set when a request is queued, so the feeder doesn't wait for its next poll.
+_queued = threading.Event()
+
+# Replied comment ids waiting to be written to the database.
+_replied_buffer = writebehind.WriteBehindBuffer(
+    lambda cids: save_entries(cids), FLUSH_SIZE, FLUSH_INTERVAL, 'replied ids')
+
+_STREAM_LAG = metrics.histogram(
+    'stream_lag_seconds', 'Age of comments when they are read from the stream',
+    buckets=(1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+_COMMENTS = metrics.counter('comments_total', 'Comments read from the stream')
+_DB_SECONDS = metrics.histogram('db_query_seconds', 'Time spent in comment id queries')
+_LOAD_SECONDS = metrics.histogram('song_load_seconds',
+                                  'Time spent loading a song from the song store')
+_GENIUS_SECONDS = metrics.histogram('genius_search_seconds',
+                                    'Time spent searching Genius.com')
+_RENDER_SECONDS = metrics.histogram('render_seconds', 'Time spent rendering a reply')
+_REPLY_SECONDS = metrics.histogram('reply_seconds', 'Time spent posting a reply')
+_REPLIES = metrics.counter('replies_total', 'Replies posted')
+
+
+def _cache_stats():
+    """Returns the counters of every cache, labelled by cache and counter."""
+    stats = {
+        'seen_comments': _seen_comments.stats(),
+        'songs': _song_cache.stats(),
+        'replies': _reply_cache.stats(),
+        'missed_songs': _missed_songs.stats(),
+        'genius_searches': _genius_flight.stats(),
+        'replied_buffer': _replied_buffer.stats(),
+        'refresher': _refresher.stats(),
+        'song_store': _song_store.stats(),
+    }
+    return {(('cache', name), ('stat', stat)): value
+            for name, values in stats.items()
+            for stat, value in values.items()}
+
+
+metrics.gauge('cache_stats', 'Counters of the in-process caches', _cache_stats)
+metrics.gauge('work_queue_jobs', 'Requests in the work queue per status',
+              lambda: {(('status', status), ): count
+                       for status, count in _work_queue.depth().items()})
+metrics.gauge('work_queue_oldest_seconds',
+              'Age of the oldest request waiting for a reply',
+              _work_queue.oldest_age)
+
+
+def main(reddit=None, genius=None):
     """
     The main function.
 
-    Configures praw and authorizes genius api, gets latest comments from the
-    subreddits, filters out comments that have already been replied. Parses
-    comment for artist name, song name, option and the specified options
-    function is called.
+    Configures praw and authorizes genius api, unless clients are passed in,
+    then starts the pipeline and feeds it the latest comments from the
+    subreddits. The ingest pipeline filters out comments that have already
+    been replied, parses them for artist name, song name and option and
+    queues them in the work queue. The reply pipeline takes the requests
+    off the queue, fetches the song, renders the reply and posts it.
     """
     # Configuring PRAW.
-    reddit = praw.Reddit(
-        'rapgeniusbot', user_agent='rapgenius v1.0 by /u/killuminati07')
+    if reddit is None:
+        reddit = praw.Reddit(
+            'rapgeniusbot', user_agent='rapgenius v1.0 by /u/killuminati07')
+
+    # Every fetch worker holds one song in flight until it is fetched.
+    fetch_workers = max(FETCH_WORKERS, GENIUS_CONCURRENCY)
 
     # Authorize access to the genius api using client access token.
-    genius = lyricsgenius.Genius(os.environ.get('GENIUS_TOKEN'))
+    if genius is None:
+        genius = geniusclient.PooledGenius(
+            os.environ.get('GENIUS_TOKEN'),
+            timeout=(3.05, GENIUS_TIMEOUT),
+            retries=GENIUS_RETRIES,
+            pool_size=2 * fetch_workers,
+            concurrency=GENIUS_CONCURRENCY)
 
     # Configure logger
     logging.basicConfig(filename='bot.log',
@@ -41,632 +264,615 @@ def main():
 
     logging.info('logging in')
 
-    # Get the latest comments from the subreddit.
-    for comment in reddit.subreddit('Eminem+Tupac+hiphop101+hiphop+hiphopheads').stream.comments():
-        # Check if bot has already replied to the comment.
-        if not is_added(comment):
-            # Parse comments for song name, artist name and option.
-            comment_list = comment.body.split(',')
-            # Check if bots username is present in the comment.
-            if comment_list[0].strip().lower() == 'geniusbot':
-                try:
-                    artist_name = comment_list[1].strip().lower()
-                    song_name = comment_list[2].strip().lower()
-                    option = comment_list[3].strip().lower()
-                    option_list = ['lyrics', 'short info',
-                                   'long info', 'relations']
-                    if option not in option_list:
-                        logging.info('Invalid Option')
-                        continue
-
-                    lyrics_suboptions = ''
-                    try:
-                        if option == 'lyrics':
-                            lyrics_suboptions = comment_list[4].strip(
-                            ).lower().split()
-                            suboptions_list = ['intro', 'outro', 'verse1',
-                                               'verse2', 'verse3', 'verse4',
-                                               'verse5', 'verse6', 'verse7',
-                                               'verse8', 'verse9', 'verse10',
-                                               'verse11', 'verse12', 'verse13',
-                                               'interlude', 'bridge', 'chorus',
-                                               'hook', 'pre-chorus', 'break',
-                                               'refrain', 'post-chorus', 'collision']
-                            flag = False
-                            for suboption in lyrics_suboptions:
-                                if suboption not in suboptions_list:
-                                    logging.info('Invalid Suboption (Section)')
-                                    flag = True
-                                    break
-                            if flag == True:
-                                continue
-
-                            beg = ''
-                            end = ''
-                            if comment_list[5]:
-                                bar_suboptions = comment_list[5].split()
-                                if bar_suboptions[0]:
-                                    beg = bar_suboptions[0]
-                                if bar_suboptions[1]:
-                                    end = bar_suboptions[1]
-                    except IndexError:
-                        pass
-
-                except IndexError:
-                    logging.info('Invalid comment format')
-                    continue
-
-                new_artist_name = artist_name.replace(
-                    " ", "").replace("'", "").replace("-", "").replace('"', "").replace("&", "")
-                new_song_name = song_name.replace(" ", "").replace(
-                    "'", "").replace("(", "").replace(")", "").replace("&", "")
-
-                # Construct the json filename.
-                filename = f"lyrics_{new_artist_name}_{new_song_name}.json"
-
-                # Find the absolute path to json file.
-                dest_path = os.path.abspath(f"lyrics/{filename}")
-
-                # Check if the json file is present in the lyrics directory.
-                if os.path.isfile(dest_path):
-                    if option == 'lyrics':
-                        if not lyrics_suboptions:
-                            post_lyrics(dest_path, comment)
-                        else:
-                            post_sub_lyrics(dest_path, comment,
-                                            lyrics_suboptions, beg, end)
-                    elif option == 'short info':
-                        post_short_song_info(dest_path, comment)
-                    elif option == 'long info':
-                        post_long_song_info(dest_path, comment)
-                    elif option == 'relations':
-                        post_song_relations(dest_path, comment)
-                else:
-                    try:
-                        # Search Genius.com for the specified song
-                        # and save songs json file.
-                        genius.search_song(song_name,
-                                           artist=artist_name,
-                                           get_full_info=True).save_lyrics()
-                    except AttributeError:
-                        logging.info("Invalid Song Request")
-                        continue
-                    else:
-                        for filename in os.listdir('.'):
-                            if filename[-4:] == 'json':
-                                filename_list = re.split(r'[_]', filename)
-
-                        artist_name = filename_list[1]
-                        old_song_name = filename_list[2]
-                        song_name = old_song_name[:-5]
-
-                        # Construct the json filename.
-                        filename = f"lyrics_{artist_name}_{song_name}.json"
-
-                        # Find the absolute path to json file.
-                        dest_path = os.path.abspath(f"lyrics/{filename}")
-
-                        try:
-                            # Move json file to lyrics directory.
-                            shutil.move(filename, dest_path)
-                        except FileNotFoundError:
-                            logging.info('Invalid Song Request')
-                            continue
-
-                        if option == 'lyrics':
-                            if not lyrics_suboptions:
-                                post_lyrics(dest_path, comment)
-                            else:
-                                post_sub_lyrics(dest_path, comment,
-                                                lyrics_suboptions, beg, end)
-                        elif option == 'short info':
-                            post_short_song_info(dest_path, comment)
-                        elif option == 'long info':
-                            post_long_song_info(dest_path, comment)
-                        elif option == 'relations':
-                            post_song_relations(dest_path, comment)
-
-
-def post_lyrics(d_path, comment):
-    """Parses json file for songs lyrics and replies lyrics to the comment."""
+    # Started before any other thread, so failing to serve metrics leaves
+    # nothing running behind.
+    metrics.start()
+
+    # One scheduler for every reply, whichever option it answers.
+    auth = getattr(reddit, 'auth', None)
+    scheduler = ratelimit.ReplyScheduler(
+        REPLY_RATE, REPLY_BURST,
+        limits=(lambda: auth.limits) if auth is not None else None,
+        reserve=QUOTA_RESERVE)
+
+    ingest = pipeline.Pipeline([
+        pipeline.Stage('parse', parse_comment),
+        pipeline.Stage('enqueue', enqueue_request),
+    ], maxsize=QUEUE_SIZE, done=ingest_done)
+    replies = pipeline.Pipeline([
+        pipeline.Stage('fetch', functools.partial(fetch_song, genius),
+                       workers=fetch_workers),
+        pipeline.Stage('render', render_reply),
+        pipeline.Stage('reply', functools.partial(send_reply, scheduler),
+                       priority=reply_priority),
+    ], maxsize=QUEUE_SIZE, done=finish_job)
+
+    # Requests that were being replied when the bot last stopped are due again.
+    recovered = _work_queue.recover()
+    if recovered:
+        logging.info(f"Recovered {recovered} requests")
+
+    _replied_buffer.start()
+    _refresher.start(functools.partial(refresh_song, genius))
+    ingest.start()
+    replies.start()
+    stopping = threading.Event()
+    draining = threading.Event()
+    feeder = threading.Thread(target=feed_replies,
+                              args=(reddit, replies, stopping, draining),
+                              name='feeder', daemon=True)
+    feeder.start()
+    # Housekeeping threads run until this main returns, so a restart
+    # doesn't leave them behind.
+    housekeeping = threading.Event()
+    housekeepers = []
+    # Every worker shares the comment ids table, one of them compacts it.
+    if WORKER_INDEX == 0:
+        housekeepers.append(threading.Thread(target=compact_db, args=(housekeeping,),
+                                             name='compactor', daemon=True))
+    # Every worker writes the request times it gathered itself.
+    housekeepers.append(threading.Thread(target=maintain_song_store,
+                                         args=(housekeeping,),
+                                         name='song-store', daemon=True))
+    for thread in housekeepers:
+        thread.start()
+
+    metrics.gauge('queue_depth', 'Items waiting in front of each pipeline stage',
+                  lambda: {(('stage', name), ): depth
+                           for pipe in (ingest, replies)
+                           for name, depth in pipe.queue_depths().items()})
+
+    ended = False
     try:
-        with open(d_path) as f:
-            data = json.load(f)
-            comment.reply(f"**\"{data.get('title').upper()}\"** **LYRICS**\
-                    \n\n---\n\n{data.get('lyrics', 'Lyrics Unavailable')}")
-            add_entry(comment)
-            logging.info('posted')
-            time.sleep(10)
-    except Exception:
-        logging.exception('Exception occurred')
+        # Get the latest comments from the subreddit.
+        subreddits = shard_subreddits(SUBREDDITS, WORKER_INDEX, WORKER_COUNT)
+        logging.info(f"Streaming {subreddits}")
+        _ingest_failed.clear()
+        _checkpoint.resume()
+        for comment in read_comments(reddit, subreddits):
+            if _ingest_failed.is_set():
+                raise StorageUnavailable('Storage failed while ingesting comments')
+            _COMMENTS.inc()
+            _checkpoint.update(comment)
+            _STREAM_LAG.observe(time.time() - comment.created_utc)
+            # Only comments addressed to the bot enter the pipeline.
+            if commands.is_trigger(comment.body):
+                ingest.submit(comment)
+        # The stream only ended cleanly if every comment read got queued.
+        ingest.stop()
+        if _ingest_failed.is_set():
+            raise StorageUnavailable('Storage failed while ingesting comments')
+        ended = True
+    finally:
+        # Stopping a stopped pipeline does nothing.
+        ingest.stop()
+        # When the stream ended cleanly, what is queued is replied before
+        # returning. Otherwise it stays queued for the next start.
+        if ended:
+            draining.set()
+        else:
+            stopping.set()
+        _queued.set()
+        feeder.join()
+        replies.stop()
+        _refresher.stop()
+        housekeeping.set()
+        for thread in housekeepers:
+            thread.join()
+        _checkpoint.save()
+        _replied_buffer.close()
+        logging.info(f"Replied ids buffer: {_replied_buffer.stats()}")
+        logging.info(f"Song cache: {_song_cache.stats()}")
+        logging.info(f"Reply cache: {_reply_cache.stats()}")
+        logging.info(f"Genius searches: {_genius_flight.stats()}")
+        logging.info(f"Missed songs cache: {_missed_songs.stats()}")
+        logging.info(f"Work queue: {_work_queue.stats()}")
+        logging.info(f"Reply scheduler: {scheduler.stats()}")
+        logging.info(f"Song refresher: {_refresher.stats()}")
+
+
+def shard_subreddits(subreddits, index, count):
+    """Returns the share of the '+' joined subreddits that worker index of count streams."""
+    names = sorted(subreddits.split('+'), key=str.lower)
+    return '+'.join(names[index::count])
+
+
+def read_comments(reddit, subreddits):
+    """
+    Yields the comments of the subreddits, starting from the checkpoint.
 
+    After a restart, the comments posted since the checkpoint (less a margin
+    for comments that were still in the pipeline) are read from the
+    subreddits listing first, oldest first. The live stream follows, minus
+    the comments the backfill already yielded or that were read before the
+    restart.
+    """
+    subreddit = reddit.subreddit(subreddits)
+    since = None
+    backfilled = set()
+    if _checkpoint.comment_id is not None:
+        since = _checkpoint.created_utc - BACKFILL_MARGIN
+        # The listing is newest first, so it is only paged through as far
+        # back as the checkpoint.
+        backlog = list(itertools.takewhile(
+            lambda comment: comment.created_utc >= since,
+            subreddit.comments(limit=BACKFILL_LIMIT)))
+        logging.info(f"Backfilling {len(backlog)} comments since {_checkpoint.comment_id}")
+        for comment in reversed(backlog):
+            backfilled.add(str(comment))
+            yield comment
+
+    for comment in subreddit.stream.comments():
+        if since is not None and comment.created_utc < since:
+            continue
+        if str(comment) in backfilled:
+            continue
+        yield comment
+
+
+class StorageUnavailable(Exception):
+    """The comment ids database or the work queue failed, the stream stops."""
+
+
+def ingest_done(item, error):
+    """
+    Stops the stream when a comment couldn't be checked against or queued
+    in storage. The checkpoint is moved back to the comment first, so the
+    backfill reads it again after run() restarts instead of dropping it.
+    """
+    if not isinstance(error, STORAGE_ERRORS):
+        return
+    comment = item.comment if isinstance(item, commands.SongRequest) else item
+    logging.error(f"Stopping the stream, {comment} will be read again")
+    _checkpoint.rewind(comment)
+    _ingest_failed.set()
 
-def post_sub_lyrics(d_path, comment, section, beg, end):
-    """Parses json file for songs lyrics and replies part of lyrics to the comment."""
-    try:
-        with open(d_path) as f:
-            data = json.load(f)
-            lyrics = data.get('lyrics', 'Lyrics Unavailable')
-            lyrics_list = lyrics.split('\n\n')
-
-            Intro = ''
-            if 'intro' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Intro' in sub_lyrics:
-                        Intro = sub_lyrics
-            Verse_1 = ''
-            if 'verse1' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 1' in sub_lyrics:
-                        Verse_1 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_1 = None
-                        bars_list = Verse_1.split('\n')
-                        Verse_1 = bars_list[beg:emp_end_1]
-                        Verse_1 = bars_list[0] + ' ' + '\n\n'.join(Verse_1)
-                    else:
-                        end = int(end)
-                        new_end_1 = end + 1
-                        bars_list = Verse_1.split('\n')
-                        Verse_1 = bars_list[beg:new_end_1]
-                        Verse_1 = bars_list[0] + ' ' + '\n\n'.join(Verse_1)
-
-            Verse_2 = ''
-            if 'verse2' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 2' in sub_lyrics:
-                        Verse_2 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_2 = None
-                        bars_list = Verse_2.split('\n')
-                        Verse_2 = bars_list[beg:emp_end_2]
-                        Verse_2 = bars_list[0] + ' ' + '\n\n'.join(Verse_2)
-                    else:
-                        end = int(end)
-                        new_end_2 = end + 1
-                        bars_list = Verse_2.split('\n')
-                        Verse_2 = bars_list[beg:new_end_2]
-                        Verse_2 = bars_list[0] + ' ' + '\n\n'.join(Verse_2)
-            Verse_3 = ''
-            if 'verse3' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 3' in sub_lyrics:
-                        Verse_3 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_3 = None
-                        bars_list = Verse_3.split('\n')
-                        Verse_3 = bars_list[beg:emp_end_3]
-                        Verse_3 = bars_list[0] + ' ' + '\n\n'.join(Verse_3)
-                    else:
-                        end = int(end)
-                        new_end_3 = end + 1
-                        bars_list = Verse_3.split('\n')
-                        Verse_3 = bars_list[beg:new_end_3]
-                        Verse_3 = bars_list[0] + ' ' + '\n\n'.join(Verse_3)
-            Verse_4 = ''
-            if 'verse4' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 4' in sub_lyrics:
-                        Verse_4 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_4 = None
-                        bars_list = Verse_4.split('\n')
-                        Verse_4 = bars_list[beg:emp_end_4]
-                        Verse_4 = bars_list[0] + ' ' + '\n\n'.join(Verse_4)
-                    else:
-                        end = int(end)
-                        new_end_4 = end + 1
-                        bars_list = Verse_4.split('\n')
-                        Verse_4 = bars_list[beg:new_end_4]
-                        Verse_4 = bars_list[0] + ' ' + '\n\n'.join(Verse_4)
-            Verse_5 = ''
-            if 'verse5' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 5' in sub_lyrics:
-                        Verse_5 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_5 = None
-                        bars_list = Verse_5.split('\n')
-                        Verse_5 = bars_list[beg:emp_end_5]
-                        Verse_5 = bars_list[0] + ' ' + '\n\n'.join(Verse_5)
-                    else:
-                        end = int(end)
-                        new_end_5 = end + 1
-                        bars_list = Verse_5.split('\n')
-                        Verse_5 = bars_list[beg:new_end_5]
-                        Verse_5 = bars_list[0] + ' ' + '\n\n'.join(Verse_5)
-            Verse_6 = ''
-            if 'verse6' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 6' in sub_lyrics:
-                        Verse_6 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_6 = None
-                        bars_list = Verse_6.split('\n')
-                        Verse_6 = bars_list[beg:emp_end_6]
-                        Verse_6 = bars_list[0] + ' ' + '\n\n'.join(Verse_6)
-                    else:
-                        end = int(end)
-                        new_end_6 = end + 1
-                        bars_list = Verse_6.split('\n')
-                        Verse_6 = bars_list[beg:new_end_6]
-                        Verse_6 = bars_list[0] + ' ' + '\n\n'.join(Verse_6)
-            Verse_7 = ''
-            if 'verse7' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 7' in sub_lyrics:
-                        Verse_7 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_7 = None
-                        bars_list = Verse_7.split('\n')
-                        Verse_7 = bars_list[beg:emp_end_7]
-                        Verse_7 = bars_list[0] + ' ' + '\n\n'.join(Verse_7)
-                    else:
-                        end = int(end)
-                        new_end_7 = end + 1
-                        bars_list = Verse_7.split('\n')
-                        Verse_7 = bars_list[beg:new_end_7]
-                        Verse_7 = bars_list[0] + ' ' + '\n\n'.join(Verse_7)
-            Verse_8 = ''
-            if 'verse8' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 8' in sub_lyrics:
-                        Verse_8 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_8 = None
-                        bars_list = Verse_8.split('\n')
-                        Verse_8 = bars_list[beg:emp_end_8]
-                        Verse_8 = bars_list[0] + ' ' + '\n\n'.join(Verse_8)
-                    else:
-                        end = int(end)
-                        new_end_8 = end + 1
-                        bars_list = Verse_8.split('\n')
-                        Verse_8 = bars_list[beg:new_end_8]
-                        Verse_8 = bars_list[0] + ' ' + '\n\n'.join(Verse_8)
-            Verse_9 = ''
-            if 'verse9' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 9' in sub_lyrics:
-                        Verse_9 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_9 = None
-                        bars_list = Verse_9.split('\n')
-                        Verse_9 = bars_list[beg:emp_end_9]
-                        Verse_9 = bars_list[0] + ' ' + '\n\n'.join(Verse_9)
-                    else:
-                        end = int(end)
-                        new_end_9 = end + 1
-                        bars_list = Verse_9.split('\n')
-                        Verse_9 = bars_list[beg:new_end_9]
-                        Verse_9 = bars_list[0] + ' ' + '\n\n'.join(Verse_9)
-            Verse_10 = ''
-            if 'verse10' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 10' in sub_lyrics:
-                        Verse_10 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_10 = None
-                        bars_list = Verse_10.split('\n')
-                        Verse_10 = bars_list[beg:emp_end_10]
-                        Verse_10 = bars_list[0] + ' ' + '\n\n'.join(Verse_10)
-                    else:
-                        end = int(end)
-                        new_end_10 = end + 1
-                        bars_list = Verse_10.split('\n')
-                        Verse_10 = bars_list[beg:new_end_10]
-                        Verse_10 = bars_list[0] + ' ' + '\n\n'.join(Verse_10)
-            Verse_11 = ''
-            if 'verse11' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 11' in sub_lyrics:
-                        Verse_11 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_11 = None
-                        bars_list = Verse_11.split('\n')
-                        Verse_11 = bars_list[beg:emp_end_11]
-                        Verse_11 = bars_list[0] + ' ' + '\n\n'.join(Verse_11)
-                    else:
-                        end = int(end)
-                        new_end_11 = end + 1
-                        bars_list = Verse_11.split('\n')
-                        Verse_11 = bars_list[beg:new_end_11]
-                        Verse_11 = bars_list[0] + ' ' + '\n\n'.join(Verse_11)
-            Verse_12 = ''
-            if 'verse12' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 12' in sub_lyrics:
-                        Verse_12 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_12 = None
-                        bars_list = Verse_12.split('\n')
-                        Verse_12 = bars_list[beg:emp_end_12]
-                        Verse_12 = bars_list[0] + ' ' + '\n\n'.join(Verse_12)
-                    else:
-                        end = int(end)
-                        new_end_12 = end + 1
-                        bars_list = Verse_12.split('\n')
-                        Verse_12 = bars_list[beg:new_end_12]
-                        Verse_12 = bars_list[0] + ' ' + '\n\n'.join(Verse_12)
-            Verse_13 = ''
-            if 'verse13' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Verse 13' in sub_lyrics:
-                        Verse_13 = sub_lyrics
-                if beg != '':
-                    beg = int(beg)
-                    if end == '':
-                        emp_end_13 = None
-                        bars_list = Verse_13.split('\n')
-                        Verse_13 = bars_list[beg:emp_end_13]
-                        Verse_13 = bars_list[0] + ' ' + '\n\n'.join(Verse_13)
-                    else:
-                        end = int(end)
-                        new_end_13 = end + 1
-                        bars_list = Verse_13.split('\n')
-                        Verse_13 = bars_list[beg:new_end_13]
-                        Verse_13 = bars_list[0] + ' ' + '\n\n'.join(Verse_13)
-            Pre_Chorus = ''
-            if 'pre-chorus' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Pre-Chorus' in sub_lyrics:
-                        Pre_Chorus = sub_lyrics
-                        break
-            Chorus = ''
-            if 'chorus' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Chorus' in sub_lyrics:
-                        Chorus = sub_lyrics
-                        break
-            Post_Chorus = ''
-            if 'post-chorus' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Post-Chorus' in sub_lyrics:
-                        Post_Chorus = sub_lyrics
-                        break
-            Refrain = ''
-            if 'refrain' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Refrain' in sub_lyrics:
-                        Refrain = sub_lyrics
-                        break
-            Collision = ''
-            if 'collision' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Collision' in sub_lyrics:
-                        Collision = sub_lyrics
-                        break
-            Hook = ''
-            if 'hook' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Hook' in sub_lyrics:
-                        Hook = sub_lyrics
-                        break
-            Interlude = ''
-            if 'interlude' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Interlude' in sub_lyrics:
-                        Interlude = sub_lyrics
-                        break
-            Bridge = ''
-            if 'bridge' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Bridge' in sub_lyrics:
-                        Bridge = sub_lyrics
-                        break
-            Break = ''
-            if 'break' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Break' in sub_lyrics:
-                        Break = sub_lyrics
-                        break
-            Outro = ''
-            if 'outro' in section:
-                for sub_lyrics in lyrics_list:
-                    if 'Outro' in sub_lyrics:
-                        Outro = sub_lyrics
-
-            comment.reply(f"**\"{data.get('title').upper()}\"** **LYRICS**\
-                \n\n---\n\n{Intro}\n\n{Verse_1}\n\n{Pre_Chorus}\n\n{Chorus}\
-                \n\n{Post_Chorus}\n\n{Hook}\n\n{Refrain}\n\n{Collision}\
-                \n\n{Bridge}\
-                \n\n{Break}\n\n{Interlude}\n\n{Verse_2}\n\n{Verse_3}\
-                \n\n{Verse_4}\n\n{Verse_5}\n\n{Verse_6}\n\n{Verse_7}\
-                \n\n{Verse_8}\n\n{Verse_9}\n\n{Verse_10}\n\n{Verse_11}\
-                \n\n{Verse_12}\n\n{Verse_13}\n\n{Outro}")
-
-            add_entry(comment)
-            logging.info('posted')
-            time.sleep(10)
-    except ValueError:
-        logging.info('Invalid Suboption (Bar)')
-    except Exception:
-        logging.exception('Exception occurred')
 
+def parse_comment(comment):
+    """Parses comment for artist name, song name and option."""
+    # Check if bot has already replied to the comment. With claims the
+    # comment is claimed when it is queued.
+    if not CLAIM_COMMENTS and is_added(comment):
+        return None
+    return commands.parse(comment)
 
-def post_short_song_info(d_path, comment):
-    """Parses json file for songs metadata and replies short song info to the comment."""
-    try:
-        with open(d_path) as f:
-            data = json.load(f)
 
-        title = data.get('title', '')
+def enqueue_request(request):
+    """
+    Queues the parsed request in the work queue.
 
-        primary_artist = data['primary_artist']['name']
+    With claims, the comment is claimed right before it is queued, in the
+    same stage, so a claimed comment is never left waiting in memory.
+    """
+    cid = str(request.comment)
+    # Skip the comment if another worker claimed it first.
+    if CLAIM_COMMENTS and not claim_entry(cid):
+        return
+    if not _work_queue.put(cid, request.to_dict()):
+        logging.info(f"Already queued {request.comment}")
+    _queued.set()
 
-        featured_artists_list = []
-        for artist in data['featured_artists']:
-            featured_artists_list.append(artist['name'])
-        featured_artists = ", ".join(featured_artists_list)
 
+def feed_replies(reddit, replies, stopping, draining):
+    """
+    Hands the due requests of the work queue to the reply pipeline.
+
+    Runs until stopping is set, or until the queue has nothing due once
+    draining is set. Old finished requests are purged every hour. Errors
+    are logged and the feeder carries on after QUEUE_POLL seconds, a job
+    whose request couldn't be handed over is retried later.
+    """
+    purged = 0
+    while not stopping.is_set():
+        job = None
         try:
-            album = data['album']['name']
-        except:
-            album = ''
-
-        release_date = data['release_date_for_display']
-        if release_date is None:
-            release_date = ''
-
-        producer_artists_list = []
-        for artist in data['producer_artists']:
-            producer_artists_list.append(artist['name'])
-        producer_artists = ", ".join(producer_artists_list)
-
-        description = data['description']['plain']
-        if description == '?':
-            description = ''
-
-        comment.reply(
-            f"**\"{data.get('title').upper()}\"** **TRACK INFO**\
-                \n\n---\n\n**Song** - {title}\
-                \n\n**Artist** - {primary_artist}\
-                \n\n**Featured Artist(s)** - {featured_artists}\
-                \n\n**Album** - {album}\n\n**Release Date** - {release_date}\
-                \n\n**Produced by** - {producer_artists}\
-                \n\n**Description** - {description}")
-        add_entry(comment)
-        logging.info('posted')
-        time.sleep(10)
-    except Exception:
-        logging.exception('Exception occurred')
+            if time.monotonic() - purged > 60 * 60:
+                _work_queue.purge(QUEUE_RETENTION)
+                purged = time.monotonic()
+            job = _work_queue.get()
+            if job is None:
+                if draining.is_set():
+                    break
+                _queued.wait(QUEUE_POLL)
+                _queued.clear()
+                continue
+            request = commands.SongRequest.from_dict(reddit.comment(job.cid),
+                                                     job.payload)
+            request.job = job
+            replies.submit(request)
+        except Exception as exception:
+            logging.exception('Exception in feeder')
+            if job is not None:
+                try:
+                    retry_job(job, exception)
+                except Exception:
+                    # Still running in the queue, recovered on the next start.
+                    logging.exception(f"Failed to retry {job.cid}")
+            stopping.wait(QUEUE_POLL)
+
+
+def finish_job(request, error):
+    """Marks the request done in the work queue, or schedules a retry if it failed."""
+    job = request.job
+    if error is None:
+        _work_queue.done(job)
+    elif isinstance(error, ratelimit.RateLimited):
+        _work_queue.defer(job, error.wait, str(error))
+    else:
+        retry_job(job, error)
+
+
+def retry_job(job, error):
+    """Schedules another attempt at a failed job, or gives up after the last one."""
+    if _work_queue.retry(job, error):
+        logging.info(f"Retrying {job.cid} after attempt {job.attempts}")
+    else:
+        # The claim is kept and the job stays failed in the queue, so the
+        # comment isn't picked up again when it is read again.
+        logging.error(f"Giving up on {job.cid} after {job.attempts} attempts")
+
+
+def fetch_song(genius, request):
+    """Finds the song in the song store, searching Genius.com on a cache miss."""
+    artist_key, title_key = songstore.song_key(request.artist_name,
+                                               request.song_name)
+
+    # Check if the song is in the song store.
+    found = _song_store.find(artist_key, title_key)
+    if found is not None:
+        request.song_id, request.version = found
+        # A stale song is served as it is and fetched again in the background.
+        if time.time() - request.version > SONG_TTL:
+            _refresher.request(request.song_id)
+        return request
+
+    # Skip songs Genius.com recently couldn't find.
+    if (artist_key, title_key) in _missed_songs:
+        logging.info("Invalid Song Request")
+        return None
+
+    # Requests for a song that is already being fetched wait for that fetch.
+    found = _genius_flight.do((artist_key, title_key),
+                              lambda: search_song(genius, request,
+                                                  artist_key, title_key))
+    if found is None:
+        return None
+    request.song_id, request.version = found
+    return request
+
+
+def search_song(genius, request, artist_key, title_key):
+    """Searches Genius.com for the song and stores it, returns (song_id, updated_at)."""
+    # A nearly identical spelling of a stored song is only trusted once
+    # Genius.com finds that same song, then its lyrics needn't be fetched.
+    near = _song_store.closest(artist_key, title_key)
+    if near is not None and confirm_song(genius, request, near[0]):
+        _song_store.add_alias(artist_key, title_key, near[0])
+        logging.info(f"Matched {artist_key} - {title_key} to song {near[0]}")
+        return near
 
+    try:
+        # Search Genius.com for the specified song.
+        with _GENIUS_SECONDS.time():
+            song = genius.search_song(request.song_name,
+                                      artist=request.artist_name,
+                                      get_full_info=True)
+        data = geniusclient.song_data(song)
+    except AttributeError:
+        logging.info("Invalid Song Request")
+        _missed_songs.add((artist_key, title_key))
+        return None
+
+    # Index the lyrics by section once, instead of on every reply.
+    sections.add_index(data)
+    return _song_store.put(artist_key, title_key, data)
+
+
+def confirm_song(genius, request, song_id):
+    """Returns whether Genius.com finds the stored song song_id for the request."""
+    find_song_id = getattr(genius, 'find_song_id', None)
+    if find_song_id is None:
+        # Plain lyricsgenius clients only search songs in full.
+        return False
+    with _GENIUS_SECONDS.time():
+        return find_song_id(request.song_name, artist=request.artist_name) == song_id
+
+
+def refresh_song(genius, song_id):
+    """
+    Fetches a stored song from Genius.com again and stores the new copy.
+
+    Storing it changes the song's version, so replies rendered from the
+    old copy are no longer served.
+    """
+    found = _song_store.names(song_id)
+    if found is None:
+        return
+    artist, title = found
+    with _GENIUS_SECONDS.time():
+        song = genius.search_song(title or '', artist=artist or '',
+                                  get_full_info=True)
+    if song is None:
+        logging.info(f"Song {song_id} not found when refreshing")
+        return
+    data = geniusclient.song_data(song)
+    if data.get('id') != song_id:
+        logging.info(f"Refreshing song {song_id} found song {data.get('id')}")
+        return
+    sections.add_index(data)
+    _song_store.put(*songstore.canonical_key(data), data)
+    logging.info(f"Refreshed song {song_id}")
+
+
+def render_reply(request):
+    """Renders the reply for the requested option, reusing replies rendered before."""
+    # The version changes whenever the song is stored again, so replies
+    # rendered from an older copy of the song are never served.
+    key = (request.song_id, request.version, request.option,
+           frozenset(request.sections), request.beg, request.end)
+    request.reply = _reply_cache.get(key)
+    if request.reply is not None:
+        request.cached = True
+        return request
 
-def post_long_song_info(d_path, comment):
-    """Parses json file for songs metadata and replies long info to the comment."""
     try:
-        with open(d_path) as f:
-            data = json.load(f)
-
-        writer_artists_list = []
-        wa_list = data.get('writer_artists')
-        for wa in wa_list:
-            writer_artists_list.append(wa.get('name'))
-            writer_artists = ", ".join(writer_artists_list)
-
-        custom_performances_dict = {}
-        custom_performances_list = data.get('custom_performances')
-        for custom_performance in custom_performances_list:
-            artists_list = custom_performance.get('artists')
-            for artist in artists_list:
-                custom_performances_dict.setdefault(
-                    custom_performance.get('label'), []).append(artist.get('name'))
-
-        custom_performance_str = ''
-        for key, value in custom_performances_dict.items():
-            custom_performance_str += f"**{key}** - {', '.join(value)}" + \
-                '\n\n'
-
-        recorded_at = data.get('recording_location')
-        if recorded_at is None:
-            recorded_at = ""
-
-        comment.reply(
-            f"**\"{data.get('title').upper()}\"** **TRACK INFO**\
-                \n\n---\n\n**Writer Artists** - {writer_artists}\
-                \n\n{custom_performance_str}\n\n**Recorded At** - {recorded_at}")
-        add_entry(comment)
-        logging.info('posted')
-        time.sleep(10)
+        song = _song_cache.load(request.song_id, request.version, load_song)
+        with _RENDER_SECONDS.time():
+            if request.option == 'lyrics':
+                if not request.sections:
+                    request.reply = render_lyrics(song)
+                else:
+                    request.reply = render_sub_lyrics(song, request.sections,
+                                                      request.beg, request.end)
+            elif request.option == 'short info':
+                request.reply = render_short_song_info(song)
+            elif request.option == 'long info':
+                request.reply = render_long_song_info(song)
+            elif request.option == 'relations':
+                request.reply = render_song_relations(song)
     except Exception:
         logging.exception('Exception occurred')
+        return None
+
+    if request.reply is None:
+        return None
+    _reply_cache.set(key, request.reply)
+    return request
+
+
+def load_song(song_id):
+    """Loads the songs record from the song store."""
+    with _LOAD_SECONDS.time():
+        return _song_store.load_record(song_id)
+
 
+def reply_priority(request):
+    """Orders the replies waiting to be sent, replies served from the cache first."""
+    return 0 if request.cached else 1
 
-def post_song_relations(d_path, comment):
-    """Parses json file for song relationships and replies the same to the comment."""
+
+def send_reply(scheduler, request):
+    """
+    Replies to the comment once the scheduler allows it.
+
+    A failed reply raises, so the request is retried from the work queue.
+    A RATELIMIT error holds back the following replies for as long as
+    reddit asked, and the request is sent again once the wait is over.
+    """
+    scheduler.acquire()
     try:
-        with open(d_path) as f:
-            data = json.load(f)
-
-        song_relationships_dict = {}
-        song_relationships_list = data.get('song_relationships')
-        for song_relationship in song_relationships_list:
-            song_relationship.get('type')
-            song_list = song_relationship.get('songs')
-            for song in song_list:
-                song_relationships_dict.setdefault(song_relationship.get(
-                    'type'), []).append(song.get('full_title'))
-        song_relationships_str = ''
-        for key, value in song_relationships_dict.items():
-            song_relationships_str += \
-                f"**{key.title().replace('_', ' ')}** - {', '.join(value)}" + '\n\n'
-
-        comment.reply(
-            f"**\"{data.get('title').upper()}\"** **TRACK RELATIONSHPS**\
-                \n\n---\n\n{song_relationships_str}")
-        add_entry(comment)
-        logging.info('posted')
-        time.sleep(10)
-    except Exception:
-        logging.exception('Exception occurred')
+        with _REPLY_SECONDS.time():
+            request.comment.reply(request.reply)
+    except praw.exceptions.RedditAPIException as exception:
+        wait = ratelimit.ratelimit_wait(exception)
+        if wait is None:
+            raise
+        scheduler.block(wait)
+        raise ratelimit.RateLimited(wait) from exception
+    if not CLAIM_COMMENTS:
+        add_entry(request.comment)
+    _REPLIES.inc()
+    logging.info('posted')
+
+
+def render_lyrics(song):
+    """Returns the lyrics reply."""
+    return f"**\"{song.title.upper()}\"** **LYRICS**\
+                    \n\n---\n\n{song.lyrics}"
+
+
+def render_sub_lyrics(song, section, beg, end):
+    """Looks up the requested sections in the songs index and returns part of the lyrics reply."""
+    sub_lyrics = sections.render(song.section_index, section, beg, end)
+    return f"**\"{song.title.upper()}\"** **LYRICS**\
+                \n\n---\n\n{sub_lyrics}"
+
+
+def render_short_song_info(song):
+    """Returns the short song info reply."""
+    return f"**\"{song.title.upper()}\"** **TRACK INFO**\
+                \n\n---\n\n**Song** - {song.title}\
+                \n\n**Artist** - {song.primary_artist}\
+                \n\n**Featured Artist(s)** - {', '.join(song.featured_artists)}\
+                \n\n**Album** - {song.album}\n\n**Release Date** - {song.release_date}\
+                \n\n**Produced by** - {', '.join(song.producer_artists)}\
+                \n\n**Description** - {song.description}"
+
+
+def render_long_song_info(song):
+    """Returns the long info reply."""
+    custom_performances_dict = {}
+    for label, artists in song.custom_performances:
+        custom_performances_dict.setdefault(label, []).extend(artists)
+
+    custom_performance_str = ''
+    for key, value in custom_performances_dict.items():
+        custom_performance_str += f"**{key}** - {', '.join(value)}" + \
+            '\n\n'
+
+    return f"**\"{song.title.upper()}\"** **TRACK INFO**\
+                \n\n---\n\n**Writer Artists** - {', '.join(song.writer_artists)}\
+                \n\n{custom_performance_str}\n\n**Recorded At** - {song.recording_location}"
+
+
+def render_song_relations(song):
+    """Returns the relationships reply."""
+    song_relationships_dict = {}
+    for relationship_type, full_titles in song.song_relationships:
+        song_relationships_dict.setdefault(relationship_type, []).extend(full_titles)
+    song_relationships_str = ''
+    for key, value in song_relationships_dict.items():
+        song_relationships_str += \
+            f"**{key.title().replace('_', ' ')}** - {', '.join(value)}" + '\n\n'
+
+    return f"**\"{song.title.upper()}\"** **TRACK RELATIONSHPS**\
+                \n\n---\n\n{song_relationships_str}"
 
 
 def is_added(comment_id):
     """Checks if comment id is present in the database."""
-    try:
-        comments1 = db.Comments.get(db.Comments.cid == comment_id)
+    cid = str(comment_id)
+    if cid in _replied_buffer:
         return True
-    except:
-        return False
+    added = _seen_comments.get(cid)
+    if added is not None:
+        return added
+
+    # A database error raises instead of passing for an unseen comment, so
+    # the comment is skipped rather than possibly replied to twice.
+    with _DB_SECONDS.labels(query='is_added').time():
+        added = db.is_added(cid)
+    _seen_comments.set(cid, added)
+    return added
 
 
 def add_entry(comment_id):
-    """Adds comment id to the database if it wasn't already in the database."""
-    if not is_added(comment_id):
-        logging.info(f"Adding {comment_id}")
-        db.Comments(cid=comment_id).save()
+    """Queues comment id to be written to the database with the next batch."""
+    cid = str(comment_id)
+    logging.info(f"Adding {cid}")
+    _replied_buffer.add(cid)
+    _seen_comments.set(cid, True)
 
 
-def flush_db():
-    """Deletes all comment ids from the database."""
-    coms = db.Comments.select()
-    for com in coms:
-        com.delete_instance()
+def save_entries(comment_ids):
+    """Adds a batch of comment ids to the database, ignoring ids that are already stored."""
+    with _DB_SECONDS.labels(query='save_entries').time():
+        db.save(comment_ids)
 
 
-if __name__ == "__main__":
+def claim_entry(comment_id):
+    """Claims comment id in the database, returns False if it was already there."""
+    cid = str(comment_id)
+    if _seen_comments.get(cid):
+        return False
+    with _DB_SECONDS.labels(query='claim').time():
+        claimed = db.claim(cid)
+    _seen_comments.set(cid, True)
+    return claimed
+
+
+def compact_db(stopping):
+    """Deletes the expired comment ids every RETENTION_INTERVAL seconds until stopping is set."""
+    while not stopping.is_set():
+        try:
+            with _DB_SECONDS.labels(query='compact').time():
+                deleted = db.compact(RETENTION_DAYS * 24 * 60 * 60, RETENTION_BATCH)
+            logging.info(f"Deleted {deleted} expired comment ids")
+        except Exception:
+            logging.exception('Failed to delete expired comment ids')
+        stopping.wait(RETENTION_INTERVAL)
+
+
+def maintain_song_store(stopping):
+    """Keeps the song store under SONG_STORE_BYTES every SONG_STORE_INTERVAL seconds until stopping is set."""
+    while not stopping.wait(SONG_STORE_INTERVAL):
+        try:
+            done = _song_store.maintain(SONG_STORE_BYTES, SONG_STORE_BATCH)
+            if done['evicted'] or done['compressed']:
+                logging.info(f"Maintained the song store: {done}")
+        except Exception:
+            logging.exception('Failed to maintain the song store')
+
+
+def flush_db():
+    """Deletes all comment ids from the database."""
+    db.compact(0, RETENTION_BATCH)
+
+
+# Error classes with what to log for them and how long to wait before
+# restarting, checked in order.
+ERROR_BACKOFFS = [
+    (prawcore.exceptions.RequestException,
+     "Error with the incomplete HTTP request", backoff.Backoff(5, 300)),
+    (prawcore.exceptions.ResponseException,
+     "Error with the completed HTTP request", backoff.Backoff(15, 600)),
+    (prawcore.exceptions.OAuthException,
+     "OAuth2 related error with the request", backoff.Backoff(60, 1800)),
+    (prawcore.exceptions.PrawcoreException, None, backoff.Backoff(15, 600)),
+    (praw.exceptions.RedditAPIException, None, backoff.Backoff(60, 900)),
+    (praw.exceptions.ClientException, None, backoff.Backoff(15, 600)),
+    (praw.exceptions.PRAWException, None, backoff.Backoff(15, 600)),
+    (Exception, None, backoff.Backoff(30, 600)),
+]
+
+# A run that lasted this many seconds before failing counts as healthy,
+# and the next failure starts again from the shortest delay.
+HEALTHY_RUN = 10 * 60
+
+
+def run():
+    """Runs main, restarting it with a backoff whenever it fails."""
     while True:
+        started = time.monotonic()
         try:
             main()
-        except prawcore.exceptions.RequestException:
-            logging.error("Error with the incomplete HTTP request")
-        except prawcore.exceptions.ResponseException:
-            logging.error("Error with the completed HTTP request")
-        except prawcore.exceptions.OAuthException:
-            logging.error("OAuth2 related error with the request")
-        except prawcore.exceptions.PrawcoreException as prawcoreerr:
-            logging.error(prawcoreerr)
-        except praw.exceptions.RedditAPIException as exception:
-            logging.error(exception)
-        except praw.exceptions.ClientException as clienterr:
-            logging.error(clienterr)
-        except praw.exceptions.PRAWException as prawerr:
-            logging.error(prawerr)
-        except Exception as err:
-            logging.error(err)
-
-        logging.info("Retrying in 5 minutes")
-        time.sleep(60 * 5)
+            err = Exception('Comment stream ended')
+        except Exception as exception:
+            err = exception
+
+        if time.monotonic() - started > HEALTHY_RUN:
+            for _, _, delay in ERROR_BACKOFFS:
+                delay.reset()
+
+        for error_class, message, delay in ERROR_BACKOFFS:
+            if isinstance(err, error_class):
+                break
+        logging.error(message or err)
+
+        wait = delay.next_delay()
+        logging.info(f"Retrying in {wait:.0f} seconds")
+        time.sleep(wait)
+
+
+def check_workers():
+    """Exits when some worker would be left without a subreddit to stream."""
+    count = len(SUBREDDITS.split('+'))
+    if WORKER_COUNT > count:
+        sys.exit(f"WORKER_COUNT is {WORKER_COUNT}, but SUBREDDITS only has "
+                 f"{count} subreddits to split between the workers")
+
+
+def run_workers():
+    """Starts WORKER_COUNT worker processes and restarts any that exits."""
+    workers = {}
+    while True:
+        for index in range(WORKER_COUNT):
+            if index not in workers or workers[index].poll() is not None:
+                env = dict(os.environ, WORKER_INDEX=str(index))
+                # Each worker has metrics of its own.
+                if metrics.METRICS_PORT:
+                    env['METRICS_PORT'] = str(int(metrics.METRICS_PORT) + index)
+                if metrics.METRICS_FILE:
+                    env['METRICS_FILE'] = f"{metrics.METRICS_FILE}.{index}"
+                workers[index] = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__)], env=env)
+                logging.info(f"Started worker {index} (pid {workers[index].pid})")
+        time.sleep(5)
+
+
+if __name__ == "__main__":
+    check_workers()
+    if WORKER_COUNT > 1 and 'WORKER_INDEX' not in os.environ:
+        run_workers()
+    else:
+        run()
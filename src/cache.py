@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Module with the in-process caches used to avoid repeating
+database queries and file reads.
+"""
+import sys
+import time
+import threading
+import collections
+
+
+class LRUCache:
+    """Thread safe mapping that forgets its least recently used key once full."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value for key and marks it as recently used."""
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._data[key]
+
+    def set(self, key, value):
+        """Stores value for key, evicting the oldest key if the cache is full."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Returns the hit and miss counters and the number of keys held."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._data),
+            }
+
+
+class TTLCache:
+    """Thread safe set of keys that expire ttl seconds after being added.
+
+    Holds at most maxsize keys, dropping the oldest first.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """Adds key, restarting its time to live."""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = time.monotonic() + self.ttl
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            expires = self._data.get(key)
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                expires = None
+            if expires is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Returns the hit and miss counters and the number of keys held."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._data),
+            }
+
+
+def sizeof(obj):
+    """Estimates the memory used by a parsed json value or a slotted record in bytes."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += sizeof(key) + sizeof(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            size += sizeof(value)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            size += sizeof(getattr(obj, name, None))
+    return size
+
+
+class SongCache:
+    """Keeps parsed songs in memory, up to max_bytes.
+
+    Entries are keyed by song and carry the version they were loaded at, a
+    newer version reloads the song. The least recently used songs are
+    evicted first.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, key, version, loader):
+        """Returns the song for key, calling loader(key) only on a miss."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == version:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        data = loader(key)
+        size = sizeof(data)
+
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            if size <= self.max_bytes:
+                self._data[key] = (version, data, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    _, (_, _, evicted) = self._data.popitem(last=False)
+                    self.size -= evicted
+        return data
+
+    def stats(self):
+        """Returns the hit and miss counters and the memory in use."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._data),
+                'bytes': self.size,
+            }
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Module to persist how far the bot got in the comment stream, so a
+restart can pick up from there instead of starting cold.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+
+class Checkpoint:
+    """High-water mark of the newest comment read from the stream.
+
+    The mark is kept in memory and written to path at most every interval
+    seconds, and when the checkpoint is closed. A rewound mark holds until
+    resume is called, so the comments read after it don't move it forward.
+    """
+
+    def __init__(self, path='checkpoint.json', interval=10.0):
+        self.path = path
+        self.interval = interval
+        self.comment_id = None
+        self.created_utc = 0.0
+        self._saved_at = 0.0
+        self._dirty = False
+        self._held = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Reads the saved mark, if there is one."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.comment_id = data['comment_id']
+            self.created_utc = data['created_utc']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            logging.warning(f"Ignoring unreadable checkpoint {self.path}")
+
+    def update(self, comment):
+        """Moves the mark forward to comment if it is newer."""
+        with self._lock:
+            if self._held or comment.created_utc < self.created_utc:
+                return
+            self.comment_id = str(comment)
+            self.created_utc = comment.created_utc
+            self._dirty = True
+            due = time.monotonic() - self._saved_at >= self.interval
+        if due:
+            self.save()
+
+    def rewind(self, comment):
+        """Moves the mark back to comment if it is older, and holds it there until resume."""
+        with self._lock:
+            if comment.created_utc < self.created_utc:
+                self.comment_id = str(comment)
+                self.created_utc = comment.created_utc
+                self._dirty = True
+            self._held = True
+        self.save()
+
+    def resume(self):
+        """Lets update move the mark forward again after a rewind."""
+        with self._lock:
+            self._held = False
+
+    def save(self):
+        """Writes the mark to disk, replacing the old file atomically."""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {'comment_id': self.comment_id,
+                    'created_utc': self.created_utc}
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logging.exception('Failed to save checkpoint')
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Module to recognize comments addressed to the bot and parse
+them into song requests.
+
+A command looks like:
+    geniusbot, <artist>, <song>, <option>[, <sections>[, <first bar> <last bar>]]
+"""
+import re
+import logging
+
+import sections
+
+
+OPTIONS = frozenset(['lyrics', 'short info', 'long info', 'relations'])
+
+SUBOPTIONS = frozenset(sections.SECTION_ORDER)
+
+# Anchored at the start of the comment, so a comment that isn't addressed
+# to the bot is rejected after looking at its first few characters.
+_TRIGGER = re.compile(r'\s*geniusbot\s*(?:,|$)', re.IGNORECASE)
+
+_COMMAND = re.compile(
+    r'\s*geniusbot\s*,'
+    r'(?P<artist>[^,]*),'
+    r'(?P<song>[^,]*),'
+    r'(?P<option>[^,]*)'
+    r'(?:,(?P<sections>[^,]*)(?:,(?P<bars>[^,]*))?)?',
+    re.IGNORECASE)
+
+
+class SongRequest:
+    """
+    A comment asking the bot for a song.
+
+    artist_name, song_name and option are lowercased strings, sections is
+    a tuple of lyrics suboptions (empty for the whole lyrics) and beg, end
+    are the bar range as ints, or None. The pipeline fills in the rest as
+    the request moves through it.
+    """
+
+    def __init__(self, comment, artist_name, song_name, option,
+                 sections=(), beg=None, end=None):
+        self.comment = comment
+        self.artist_name = artist_name
+        self.song_name = song_name
+        self.option = option
+        self.sections = sections
+        self.beg = beg
+        self.end = end
+        self.song_id = None
+        self.version = None
+        self.reply = None
+        self.cached = False
+        self.job = None
+
+    def to_dict(self):
+        """Returns the parsed fields, to be queued as json."""
+        return {'artist_name': self.artist_name, 'song_name': self.song_name,
+                'option': self.option, 'sections': list(self.sections),
+                'beg': self.beg, 'end': self.end}
+
+    @classmethod
+    def from_dict(cls, comment, fields):
+        """Rebuilds a request for comment from the fields to_dict returned."""
+        return cls(comment, fields['artist_name'], fields['song_name'],
+                   fields['option'], tuple(fields['sections']),
+                   fields['beg'], fields['end'])
+
+
+def is_trigger(body):
+    """Tells whether a comment body is addressed to the bot."""
+    return _TRIGGER.match(body) is not None
+
+
+def parse(comment):
+    """Parses a comment addressed to the bot into a SongRequest, or None if it's invalid."""
+    match = _COMMAND.match(comment.body)
+    if match is None:
+        logging.info('Invalid comment format')
+        return None
+
+    option = match.group('option').strip().lower()
+    if option not in OPTIONS:
+        logging.info('Invalid Option')
+        return None
+
+    request = SongRequest(comment,
+                          match.group('artist').strip().lower(),
+                          match.group('song').strip().lower(),
+                          option)
+    if option != 'lyrics' or match.group('sections') is None:
+        return request
+
+    request.sections = tuple(match.group('sections').lower().split())
+    if not SUBOPTIONS.issuperset(request.sections):
+        logging.info('Invalid Suboption (Section)')
+        return None
+
+    bars = (match.group('bars') or '').split()
+    try:
+        if bars:
+            request.beg = int(bars[0])
+        if len(bars) > 1:
+            request.end = int(bars[1])
+    except ValueError:
+        logging.info('Invalid Suboption (Bar)')
+        return None
+    return request
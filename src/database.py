@@ -1,28 +1,191 @@
 # -*- coding: utf-8 -*-
 """
-Module to connect to mysql database which is used
-to store comment ids.
+Module to connect to the database which is used to store
+comment ids, mysql in production or a sqlite file locally.
+
+Importing the module doesn't connect. Connections are taken from a pool
+when a query runs and given back after it, and the table is created on
+first use.
 """
 import os
+import datetime
+import functools
+import threading
 
 from peewee import *
+from playhouse.migrate import MySQLMigrator, SchemaMigrator, migrate
+from playhouse.pool import PooledMySQLDatabase, PooledSqliteDatabase
+from playhouse.shortcuts import ReconnectMixin
+
+
+# Reddit comment ids are short base36 strings, this leaves room to spare.
+CID_LENGTH = 16
+
+# 'mysql', or 'sqlite' for local and benchmark runs.
+DB_BACKEND = os.environ.get('DB_BACKEND', 'mysql')
+
+# Sqlite file used by the sqlite backend.
+DB_PATH = os.environ.get('DB_PATH', 'comments.db')
+
+# Connections kept open for the bot's threads, and seconds after which
+# an idle one is closed instead of reused.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_STALE_TIMEOUT = int(os.environ.get('DB_STALE_TIMEOUT', 300))
+
+
+class ReconnectingMySQLDatabase(ReconnectMixin, PooledMySQLDatabase):
+    """Pooled mysql database that reconnects when the server dropped the connection."""
+
+
+def make_database(backend):
+    """Returns the database of the backend, without connecting to it."""
+    if backend == 'mysql':
+        return ReconnectingMySQLDatabase(
+            'rapgeniusbot',
+            host=os.environ.get('MYSQL_HOST', 'localhost'),
+            user=os.environ.get('MYSQL_USER', 'root'),
+            passwd=os.environ.get('MYSQL_PASSWORD'),
+            max_connections=DB_POOL_SIZE,
+            stale_timeout=DB_STALE_TIMEOUT,
+            timeout=30)
+    if backend == 'sqlite':
+        return PooledSqliteDatabase(
+            DB_PATH,
+            pragmas={'journal_mode': 'wal', 'synchronous': 'normal',
+                     'busy_timeout': 30000},
+            max_connections=DB_POOL_SIZE,
+            stale_timeout=DB_STALE_TIMEOUT,
+            timeout=30,
+            # Pooled connections are handed from thread to thread.
+            check_same_thread=False)
+    raise ValueError(f"Unknown database backend {backend!r}")
 
 
 # Initializing the database.
-db = MySQLDatabase('rapgeniusbot',
-                   host='localhost',
-                   user='root',
-                   passwd=os.environ.get('MYSQL_PASSWORD'))
+db = make_database(DB_BACKEND)
+
+_setup_lock = threading.Lock()
+_is_setup = False
 
 
 class Comments(Model):
-    cid = TextField()
+    cid = FixedCharField(max_length=CID_LENGTH, unique=True)
+    # When the id was stored, in utc, so old ids can be deleted.
+    added_at = DateTimeField(default=datetime.datetime.utcnow, index=True)
 
     class Meta:
         database = db
 
 
-db.connect()
+def migrate_cid():
+    """Makes cid a fixed width, uniquely indexed column on tables created before it was one."""
+    table = Comments._meta.table_name
+    for index in db.get_indexes(table):
+        if index.columns == ['cid'] and index.unique:
+            return
+
+    # Remove duplicate ids first, otherwise the unique index can't be built.
+    db.execute_sql(f"DELETE c1 FROM {table} c1 JOIN {table} c2 "
+                   f"ON c1.cid = c2.cid AND c1.id > c2.id")
+
+    migrator = MySQLMigrator(db)
+    migrate(
+        migrator.alter_column_type(table, 'cid',
+                                   FixedCharField(max_length=CID_LENGTH)),
+        migrator.add_index(table, ('cid',), True),
+    )
+
+
+def migrate_added_at():
+    """Adds the added_at column to tables created before it, dated now for existing ids."""
+    table = Comments._meta.table_name
+    if any(column.name == 'added_at' for column in db.get_columns(table)):
+        return
+
+    # Added as a nullable column and filled in, as making it NOT NULL
+    # would mean rebuilding the table on sqlite.
+    migrator = SchemaMigrator.from_database(db)
+    migrate(
+        migrator.add_column(table, 'added_at', DateTimeField(null=True)),
+        migrator.add_index(table, ('added_at',), False),
+    )
+    Comments.update(added_at=datetime.datetime.utcnow()).where(
+        Comments.added_at.is_null()).execute()
+
+
+def setup():
+    """Creates or migrates the table, the first time it is called."""
+    global _is_setup
+    with _setup_lock:
+        if _is_setup:
+            return
+        with db.connection_context():
+            # Tables from older versions are migrated before create_table
+            # adds the indexes of the current version.
+            if Comments.table_exists():
+                if isinstance(db, MySQLDatabase):
+                    migrate_cid()
+                migrate_added_at()
+            # The True flag won't alarm if table exists.
+            Comments.create_table(True)
+        _is_setup = True
+
+
+def connected(func):
+    """Runs func on a pooled connection, setting the database up first if needed."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _is_setup:
+            setup()
+        with db.connection_context():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@connected
+def is_added(cid):
+    """Tells whether comment id is stored. Database errors are raised, not taken for a no."""
+    return Comments.select().where(Comments.cid == cid).exists()
+
+
+@connected
+def save(cids):
+    """Stores a batch of comment ids, ignoring ids that are already stored."""
+    Comments.insert_many([{'cid': cid} for cid in cids]).on_conflict_ignore().execute()
+
+
+@connected
+def claim(cid):
+    """Atomically stores comment id, returns False if another worker stored it first."""
+    query = Comments.insert(cid=cid).on_conflict_ignore()
+    return db.execute(query).rowcount == 1
+
+
+def compact(max_age, batch_size=1000):
+    """
+    Deletes the ids stored more than max_age seconds ago, batch_size ids
+    at a time, and returns how many were deleted.
+
+    Each batch is its own short delete, so the bot's own queries are never
+    held up for long.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+    deleted = 0
+    while True:
+        count = _delete_batch(cutoff, batch_size)
+        deleted += count
+        if count < batch_size:
+            return deleted
+
 
-# The True flag won't alarm if table exists.
-Comments.create_table(True)
+@connected
+def _delete_batch(cutoff, batch_size):
+    """Deletes up to batch_size ids stored before cutoff."""
+    # Mysql can't take a limit inside an IN subquery, so the ids are read first.
+    ids = [row.id for row in Comments.select(Comments.id)
+           .where(Comments.added_at < cutoff)
+           .order_by(Comments.added_at)
+           .limit(batch_size)]
+    if not ids:
+        return 0
+    return Comments.delete().where(Comments.id.in_(ids)).execute()
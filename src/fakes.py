@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Module with offline stand-ins for the reddit and genius clients, so
+the bot can be run and measured without credentials or network.
+"""
+import os
+import json
+import time
+import threading
+
+from lyricsgenius.song import Song
+
+import songstore
+
+
+class FakeComment:
+    """A recorded comment that remembers the replies posted to it."""
+
+    def __init__(self, id, body, created_utc=None, reply_latency=0.0):
+        self.id = id
+        self.body = body
+        self.created_utc = time.time() if created_utc is None else created_utc
+        self.reply_latency = reply_latency
+        self.read_at = None
+        self.replies = []
+        self.replied_at = None
+
+    def reply(self, body):
+        """Records the reply, after sleeping for the configured latency."""
+        if self.reply_latency:
+            time.sleep(self.reply_latency)
+        self.replies.append(body)
+        self.replied_at = time.monotonic()
+
+    def __str__(self):
+        return self.id
+
+
+class _FakeStream:
+    """The stream attribute of a FakeSubreddit."""
+
+    def __init__(self, comments):
+        self._comments = comments
+
+    def comments(self, **kwargs):
+        """Yields the recorded comments, stamping when each one was read."""
+        for comment in self._comments:
+            comment.read_at = time.monotonic()
+            yield comment
+
+
+class FakeSubreddit:
+    """Subreddit whose stream replays recorded comments."""
+
+    def __init__(self, comments):
+        self._comments = comments
+        self.stream = _FakeStream(comments)
+
+    def comments(self, limit=100):
+        """Returns the newest recorded comments, newest first."""
+        return list(reversed(self._comments))[:limit]
+
+
+class FakeReddit:
+    """Stands in for praw.Reddit, every subreddit replays the same comments."""
+
+    def __init__(self, comments):
+        self.comments = comments
+        self._by_id = {comment.id: comment for comment in comments}
+
+    def subreddit(self, name):
+        return FakeSubreddit(self.comments)
+
+    def comment(self, id):
+        """Returns the recorded comment with the id, like praw's lazy comment."""
+        return self._by_id[id]
+
+    @classmethod
+    def from_jsonl(cls, path, reply_latency=0.0):
+        """Loads comments from a file of {"id", "body", "created_utc"} json lines."""
+        comments = []
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    comments.append(FakeComment(record['id'], record['body'],
+                                                record.get('created_utc'),
+                                                reply_latency))
+        return cls(comments)
+
+
+class FakeSong(Song):
+    """
+    Stands in for a lyricsgenius song: to_dict only has the summary, the
+    recorded songs json is in _body, like the real song keeps it.
+    """
+
+    def __init__(self, data):
+        self._body = json.loads(json.dumps(data))
+        self._url = self._body.get('url')
+        self._api_path = self._body.get('api_path')
+        self._id = self._body.get('id')
+
+
+class FakeGenius:
+    """Stands in for lyricsgenius.Genius, serving recorded songs json.
+
+    Every search sleeps for latency seconds, like a round trip to
+    Genius.com would take, and is counted.
+    """
+
+    def __init__(self, songs, latency=0.0):
+        self.latency = latency
+        self.searches = 0
+        self._lock = threading.Lock()
+        self._songs = {}
+        for data in songs:
+            self._songs[songstore.canonical_key(data)] = data
+
+    def search_song(self, title, artist='', get_full_info=True):
+        """Returns the recorded song matching artist and title, or None."""
+        data = self._search(title, artist)
+        return FakeSong(data) if data is not None else None
+
+    def find_song_id(self, title, artist=''):
+        """Returns the id of the recorded song matching artist and title, or None."""
+        data = self._search(title, artist)
+        return data['id'] if data is not None else None
+
+    def _search(self, title, artist):
+        """Returns the recorded songs json matching artist and title, after the latency."""
+        with self._lock:
+            self.searches += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self._songs.get(songstore.song_key(artist, title))
+
+    @classmethod
+    def from_dir(cls, directory, latency=0.0):
+        """Loads every songs json file of a directory, such as the old lyrics/ cache."""
+        songs = []
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.json'):
+                with open(os.path.join(directory, filename)) as f:
+                    songs.append(json.load(f))
+        return cls(songs, latency)
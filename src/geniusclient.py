@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Module with a Genius.com client that keeps its connections alive
+in a pool, puts a timeout on every request and retries the ones
+that fail for a passing reason.
+
+In async mode the song details call and the lyrics page scrape of a
+search run at the same time, with at most concurrency songs in flight.
+"""
+import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import requests
+import lyricsgenius
+from lyricsgenius.song import Song
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+USER_AGENT = 'rapgenius v1.0 by /u/killuminati07'
+
+# Responses worth trying again: rate limited, or a server having a bad moment.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def make_session(pool_size=8, retries=3, backoff_factor=0.5):
+    """Returns a requests session keeping up to pool_size connections per host alive."""
+    retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                  backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
+
+def song_data(song):
+    """
+    Returns the whole songs json of a lyricsgenius song, lyrics included.
+
+    Song.to_dict only keeps the title, album, year, lyrics and image, the
+    replies need the full Genius.com response save_lyrics used to write.
+    """
+    return json.loads(song.to_json(full_data=True))
+
+
+class PooledGenius(lyricsgenius.Genius):
+    """
+    lyricsgenius.Genius whose requests share a pooled keep-alive session.
+
+    timeout is the seconds to wait for a response, or a (connect, read)
+    pair. lyricsgenius' fixed sleep after every request is dropped, the
+    retries back off instead when Genius.com pushes back. With concurrency
+    above 0, search_song runs through search_song_async on an event loop
+    of its own.
+    """
+
+    def __init__(self, token, timeout=(3.05, 10), retries=3, pool_size=8,
+                 concurrency=0):
+        super().__init__(token, timeout=timeout, sleep_time=0, verbose=False)
+        self._token = token
+        self._session = make_session(pool_size, retries)
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._executor = None
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    def _make_request(self, path, method='GET', params_=None):
+        """Makes a request to the api."""
+        params = dict(params_ or {})
+        params['text_format'] = self.response_format
+        response = self._session.request(
+            method, self.api_root + path, params=params, timeout=self.timeout,
+            headers={'Authorization': f"Bearer {self._token}"})
+        response.raise_for_status()
+        return response.json()['response']
+
+    def search_genius_web(self, search_term, per_page=5):
+        """Searches Genius.com the way its website does."""
+        url = ("https://genius.com/api/search/multi?"
+               + urlencode({'per_page': per_page, 'q': search_term}))
+        response = self._session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['response']
+
+    def _scrape_song_lyrics_from_url(self, url):
+        """Returns the lyrics on a Genius.com song page, or None if it has none."""
+        page = self._session.get(url, timeout=self.timeout)
+        if page.status_code == 404:
+            return None
+        page.raise_for_status()
+        return parse_lyrics(page.text)
+
+    def _find_song(self, title, artist):
+        """Returns the search result of the song, or None if there is no such song."""
+        search_term = f"{title} {artist}".strip()
+        response = self.search_genius_web(search_term)
+        result = self._get_item_from_search_response(response, title, type_='song',
+                                                     result_type='title')
+        if not result:
+            return None
+        # Reject liner notes, track lists and the like.
+        if self.skip_non_songs and not self._result_is_lyrics(result['title']):
+            return None
+        return result
+
+    def find_song_id(self, title, artist=''):
+        """Returns the id of the song matching title and artist, with a single search."""
+        result = self._find_song(title, artist)
+        return result['id'] if result else None
+
+    def search_song(self, title, artist='', get_full_info=True):
+        """Returns the lyricsgenius.Song matching title and artist, or None."""
+        if self.concurrency:
+            return self._run(self.search_song_async(title, artist, get_full_info))
+
+        result = self._find_song(title, artist)
+        if result is None:
+            return None
+        info = dict(result)
+        if get_full_info:
+            info.update(self.get_song(result['id'])['song'])
+        lyrics = self._scrape_song_lyrics_from_url(info['url'])
+        return Song(info, lyrics) if lyrics else None
+
+    async def search_song_async(self, title, artist='', get_full_info=True):
+        """
+        Returns the lyricsgenius.Song matching title and artist, or None.
+
+        The details call and the lyrics scrape only need the search result,
+        so they run at the same time. Every search waits for one of the
+        concurrency slots of the client, which must be used from a single
+        event loop.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency or 1)
+            self._executor = ThreadPoolExecutor(2 * (self.concurrency or 1),
+                                                thread_name_prefix='genius')
+        async with self._semaphore:
+            result = await self._call(self._find_song, title, artist)
+            if result is None:
+                return None
+            calls = [self._call(self._scrape_song_lyrics_from_url, result['url'])]
+            if get_full_info:
+                calls.append(self._call(self.get_song, result['id']))
+            lyrics, *details = await asyncio.gather(*calls)
+
+        info = dict(result)
+        for detail in details:
+            info.update(detail['song'])
+        return Song(info, lyrics) if lyrics else None
+
+    def _call(self, func, *args):
+        """Runs a blocking request on the client's threads, without holding up the loop."""
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _run(self, coroutine):
+        """Runs coroutine on the client's event loop thread and waits for its result."""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='genius-loop',
+                                 daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+
+def parse_lyrics(html):
+    """Returns the lyrics in a Genius.com song page, section headers included, or None."""
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # Older pages keep the lyrics in one div.
+    old_div = soup.find('div', class_='lyrics')
+    if old_div:
+        return old_div.get_text().strip('\n')
+
+    for tag in soup.find_all('div'):
+        if 'Lyrics__Root' in str(tag.get('class', '')):
+            return tag.get_text('\n').replace('\n[', '\n\n[').strip('\n')
+    return None
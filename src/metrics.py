@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Module to collect counters and latency histograms and expose them
+in the prometheus text format, over http or as a snapshot file.
+
+Metrics are only collected when METRICS_PORT or METRICS_FILE is set,
+otherwise every metric is a shared object whose methods do nothing.
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+PREFIX = 'rapgeniusbot_'
+
+METRICS_PORT = os.environ.get('METRICS_PORT')
+METRICS_FILE = os.environ.get('METRICS_FILE')
+METRICS_INTERVAL = float(os.environ.get('METRICS_INTERVAL', 60))
+
+ENABLED = bool(METRICS_PORT or METRICS_FILE)
+
+# Latency buckets in seconds, from a cache hit up to a slow Genius.com search.
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+
+_families = []
+_families_lock = threading.Lock()
+_started = False
+
+
+class Counter:
+    """A value that only goes up."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Adds amount to the counter."""
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram:
+    """Counts observed values into buckets."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Records one value."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        """Observes how long the with block took, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (('le', str(bound)),), cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, cumulative
+
+
+class _Null:
+    """Stands in for every metric while metrics are disabled."""
+
+    def labels(self, **labels):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return contextlib.nullcontext()
+
+
+_NULL = _Null()
+
+
+class _Family:
+    """A metric name with one child metric per set of label values."""
+
+    def __init__(self, name, help, kind, factory):
+        self.name = PREFIX + name
+        self.help = help
+        self.kind = kind
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        """Returns the child metric for the label values."""
+        key = tuple(sorted(labels.items()))
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._factory())
+        return child
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self):
+        for labels, child in list(self._children.items()):
+            yield from child.samples(self.name, labels)
+
+
+class _Gauge:
+    """A value read from a callback when the metrics are rendered.
+
+    The callback returns a number, or a dict of label dicts (as sorted
+    tuples of pairs) to numbers.
+    """
+
+    def __init__(self, name, help, func):
+        self.name = PREFIX + name
+        self.help = help
+        self.kind = 'gauge'
+        self.func = func
+
+    def samples(self):
+        try:
+            value = self.func()
+        except Exception:
+            logging.exception(f"Failed to read {self.name}")
+            return
+        if isinstance(value, dict):
+            for labels, number in value.items():
+                yield self.name, labels, number
+        else:
+            yield self.name, (), value
+
+
+def _register(family):
+    """Adds a metric to the registry, replacing one registered under the same name."""
+    with _families_lock:
+        _families[:] = [f for f in _families if f.name != family.name]
+        _families.append(family)
+    return family
+
+
+def counter(name, help):
+    """Returns a counter, or a do nothing stand in while metrics are disabled."""
+    if not ENABLED:
+        return _NULL
+    return _register(_Family(name, help, 'counter', Counter))
+
+
+def histogram(name, help, buckets=BUCKETS):
+    """Returns a histogram, or a do nothing stand in while metrics are disabled."""
+    if not ENABLED:
+        return _NULL
+    return _register(_Family(name, help, 'histogram',
+                             lambda: Histogram(buckets)))
+
+
+def gauge(name, help, func):
+    """Registers a gauge read from func while metrics are enabled."""
+    if ENABLED:
+        _register(_Gauge(name, help, func))
+
+
+def render():
+    """Returns every metric in the prometheus text format."""
+    lines = []
+    with _families_lock:
+        families = list(_families)
+    for family in families:
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.kind}")
+        for name, labels, value in family.samples():
+            if labels:
+                label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{name}{{{label_str}}} {value}")
+            else:
+                lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Serves the metrics on every GET request."""
+
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _write_snapshots(path, interval):
+    """Rewrites the snapshot file every interval seconds."""
+    while True:
+        time.sleep(interval)
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(render())
+            os.replace(tmp_path, path)
+        except OSError:
+            logging.exception('Failed to write metrics snapshot')
+
+
+def start():
+    """Starts the http endpoint and the snapshot writer that are configured."""
+    global _started
+    if _started:
+        return
+    if METRICS_PORT:
+        # Raises before anything is started if the port is taken.
+        server = ThreadingHTTPServer(('127.0.0.1', int(METRICS_PORT)), _Handler)
+        threading.Thread(target=server.serve_forever, name='metrics-http',
+                         daemon=True).start()
+        logging.info(f"Serving metrics on port {METRICS_PORT}")
+    if METRICS_FILE:
+        threading.Thread(target=_write_snapshots,
+                         args=(METRICS_FILE, METRICS_INTERVAL),
+                         name='metrics-file', daemon=True).start()
+    _started = True
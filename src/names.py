@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Module to normalize artist and song names and compare
+near-miss spellings of them.
+"""
+import re
+import unicodedata
+
+
+# Everything that isn't a letter or a digit.
+_PUNCTUATION = re.compile(r'[\W_]+')
+
+# Numbers in a key, which tell apart songs like "Stan" and "Stan 2".
+_DIGITS = re.compile(r'\d+')
+
+
+def normalize(name):
+    """Lowercases name and strips accents, spaces and punctuation from it."""
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return _PUNCTUATION.sub('', name.lower())
+
+
+def trigrams(key):
+    """Returns the set of three letter slices of a normalized key."""
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b):
+    """Returns the letters to insert, delete, replace or swap to turn a into b."""
+    previous, row = None, list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        before, previous, row = previous, row, [i]
+        for j, y in enumerate(b, 1):
+            cost = min(previous[j] + 1, row[j - 1] + 1,
+                       previous[j - 1] + (x != y))
+            # Two neighbouring letters swapped count as one edit.
+            if i > 1 and j > 1 and x == b[j - 2] and a[i - 2] == y:
+                cost = min(cost, before[j - 2] + 1)
+            row.append(cost)
+    return row[-1]
+
+
+def closest(key, candidates, threshold):
+    """
+    Returns the candidate nearly identical to key, or None.
+
+    A candidate must have the same numbers as key, so "Stan 2" never
+    matches "Stan", and 1 - edits / length must reach threshold, so a
+    0.9 threshold allows one typo per ten letters.
+    """
+    digits = _DIGITS.findall(key)
+    best, best_score = None, threshold
+    for candidate in candidates:
+        if _DIGITS.findall(candidate) != digits:
+            continue
+        length = max(len(key), len(candidate))
+        score = 1 - edit_distance(key, candidate) / length if length else 0.0
+        if score >= best_score:
+            best, best_score = candidate, score
+    return best
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Module to run the bot as a set of stages connected by bounded
+queues, with a token bucket limiting how fast replies go out.
+"""
+import time
+import heapq
+import queue
+import itertools
+import logging
+import threading
+
+import metrics
+
+
+# Marker put on a queue to tell a stage worker to exit.
+_STOP = object()
+
+_STAGE_SECONDS = metrics.histogram('stage_seconds',
+                                   'Time spent handling an item, per stage')
+_STAGE_ITEMS = metrics.counter('stage_items_total',
+                               'Items handled per stage and outcome')
+
+
+class TokenBucket:
+    """Blocks callers so that on average no more than rate calls per second pass."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """Adds the tokens earned since the last refill."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Takes a token, sleeping until one is available."""
+        with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                time.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class PriorityQueue(queue.Queue):
+    """Bounded queue handing out the item with the lowest key(item) first.
+
+    Items with equal keys come out in the order they were put.
+    """
+
+    def __init__(self, maxsize, key):
+        super().__init__(maxsize)
+        self.key = key
+
+    def _init(self, maxsize):
+        self.queue = []
+        self._count = itertools.count()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        # The stop marker goes after every item, so they still drain.
+        rank = (1, 0) if item is _STOP else (0, self.key(item))
+        heapq.heappush(self.queue, (rank, next(self._count), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
+
+
+class Stage:
+    """A named step of the pipeline run by one or more worker threads.
+
+    func takes an item and returns the item for the next stage, or None
+    to drop it. With priority, waiting items are handled lowest
+    priority(item) first instead of in arrival order.
+    """
+
+    def __init__(self, name, func, workers=1, priority=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.priority = priority
+
+
+class Pipeline:
+    """Chains stages together with bounded queues.
+
+    done, if given, is called with every item leaving the pipeline and the
+    exception it failed with, or None if it passed the last stage or was
+    dropped.
+    """
+
+    def __init__(self, stages, maxsize=100, done=None):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize) if stage.priority is None
+                       else PriorityQueue(maxsize, stage.priority)
+                       for stage in stages]
+        self.done = done
+        self._threads = {}
+
+    def start(self):
+        """Starts the worker threads of every stage."""
+        for i, stage in enumerate(self.stages):
+            in_q = self.queues[i]
+            out_q = self.queues[i + 1] if i + 1 < len(self.queues) else None
+            threads = []
+            for n in range(stage.workers):
+                thread = threading.Thread(target=self._work,
+                                          args=(stage, in_q, out_q),
+                                          name=f"{stage.name}-{n}",
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+            self._threads[stage.name] = threads
+
+    def submit(self, item):
+        """Hands an item to the first stage, blocking only if its queue is full."""
+        self.queues[0].put(item)
+
+    def stop(self):
+        """Lets every queued item drain through the stages, then stops the workers."""
+        for i, stage in enumerate(self.stages):
+            # Already stopped.
+            if stage.name not in self._threads:
+                continue
+            for _ in range(stage.workers):
+                self.queues[i].put(_STOP)
+            for thread in self._threads.pop(stage.name, []):
+                thread.join()
+
+    def queue_depths(self):
+        """Returns the number of items waiting in front of each stage."""
+        return {stage.name: q.qsize() for stage, q in zip(self.stages, self.queues)}
+
+    def _work(self, stage, in_q, out_q):
+        """Worker loop of a single stage thread."""
+        seconds = _STAGE_SECONDS.labels(stage=stage.name)
+        passed = _STAGE_ITEMS.labels(stage=stage.name, outcome='passed')
+        dropped = _STAGE_ITEMS.labels(stage=stage.name, outcome='dropped')
+        failed = _STAGE_ITEMS.labels(stage=stage.name, outcome='failed')
+        while True:
+            item = in_q.get()
+            if item is _STOP:
+                break
+            try:
+                with seconds.time():
+                    result = stage.func(item)
+            except Exception as exception:
+                failed.inc()
+                logging.exception(f"Exception in {stage.name} stage")
+                self._finish(item, exception)
+                continue
+            if result is None:
+                dropped.inc()
+                self._finish(item, None)
+                continue
+            passed.inc()
+            if out_q is not None:
+                out_q.put(result)
+            else:
+                self._finish(result, None)
+
+    def _finish(self, item, error):
+        """Hands an item that left the pipeline to the done callback."""
+        if self.done is None:
+            return
+        try:
+            self.done(item, error)
+        except Exception:
+            logging.exception('Exception in done callback')
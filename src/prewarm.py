@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Module to fill the song store ahead of time, so the first wave
+of requests after a release is served without calling Genius.com.
+
+Usage:
+    python prewarm.py --artists "Eminem" "Kendrick Lamar" --max-songs 20
+    python prewarm.py --songs songs.txt
+
+A songs file has one "artist, song" pair per line. Finished artists and
+songs are appended to the progress file, and skipped when the same
+command is run again.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from lyricsgenius.song import Song
+
+import geniusclient
+import pipeline
+import sections
+import songstore
+
+
+class Prewarmer:
+    """Fetches songs from Genius.com into the song store with bounded parallelism."""
+
+    def __init__(self, genius, store, limiter, progress_path):
+        self.genius = genius
+        self.store = store
+        self.limiter = limiter
+        self.progress_path = progress_path
+        self.done = set()
+        self.stored = 0
+        self.skipped = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        if os.path.isfile(progress_path):
+            with open(progress_path) as f:
+                self.done = {line.rstrip('\n') for line in f}
+
+    def _store(self, artist_key, title_key, data):
+        """Stores a songs json with its section index."""
+        self.store.put(artist_key, title_key, sections.add_index(data))
+
+    def _finish(self, task, stored):
+        """Records a finished task in the progress file."""
+        with self._lock:
+            self.stored += stored
+            self.done.add(task)
+            with open(self.progress_path, 'a') as f:
+                f.write(task + '\n')
+
+    def warm_song(self, artist_name, song_name):
+        """Fetches one song unless it is already stored."""
+        task = f"song:{artist_name}, {song_name}"
+        artist_key, title_key = songstore.song_key(artist_name, song_name)
+        if task in self.done or self.store.find(artist_key, title_key):
+            with self._lock:
+                self.skipped += 1
+            return
+
+        self.limiter.acquire()
+        song = self.genius.search_song(song_name, artist=artist_name,
+                                       get_full_info=True)
+        if song is None:
+            logging.info(f"Song not found: {artist_name}, {song_name}")
+        else:
+            self._store(artist_key, title_key, geniusclient.song_data(song))
+        self._finish(task, 0 if song is None else 1)
+
+    def warm_artist(self, artist_name, max_songs):
+        """
+        Fetches the most popular songs of an artist.
+
+        The artist's songs are listed page by page instead of through
+        search_artist, so every page and every song fetched waits for the
+        limiter. Songs already stored count towards max_songs.
+        """
+        task = f"artist:{artist_name}"
+        if task in self.done:
+            with self._lock:
+                self.skipped += 1
+            return
+
+        self.limiter.acquire()
+        response = self.genius.search_genius_web(artist_name)
+        artist = self.genius._get_item_from_search_response(
+            response, artist_name, type_='artist', result_type='name')
+        if not artist:
+            logging.info(f"Artist not found: {artist_name}")
+            self._finish(task, 0)
+            return
+
+        kept = 0
+        fetched = 0
+        page = 1
+        while page and kept < max_songs:
+            self.limiter.acquire()
+            songs = self.genius.get_artist_songs(artist['id'], sort='popularity',
+                                                 per_page=50, page=page)
+            for info in songs['songs']:
+                if kept >= max_songs:
+                    break
+                # Like search_artist, skip features and non songs.
+                if (info.get('primary_artist') or {}).get('id') != artist['id']:
+                    continue
+                if (self.genius.skip_non_songs
+                        and not self.genius._result_is_lyrics(info['title'])):
+                    continue
+                if self.store.names(info['id']) is None:
+                    if not self._fetch(info):
+                        continue
+                    fetched += 1
+                kept += 1
+            page = songs['next_page']
+        self._finish(task, fetched)
+
+    def _fetch(self, info):
+        """Fetches and stores the song of an artist songs listing, returns False if it has no lyrics."""
+        self.limiter.acquire()
+        lyrics = self.genius._scrape_song_lyrics_from_url(info['url'])
+        if not lyrics:
+            return False
+        song = Song(self.genius.get_song(info['id']), lyrics)
+        data = geniusclient.song_data(song)
+        self._store(*songstore.canonical_key(data), data)
+        return True
+
+    def run(self, tasks, workers):
+        """Runs (function, args) tasks on a pool of threads and reports throughput."""
+        start = time.monotonic()
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(func, *args) for func, args in tasks]
+            for count, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except Exception:
+                    self.failed += 1
+                    logging.exception('Exception occurred')
+                if count % 10 == 0 or count == len(futures):
+                    self.report(count, len(futures), time.monotonic() - start)
+
+    def report(self, count, total, elapsed):
+        """Logs how far the run got and how fast it is going."""
+        rate = self.stored / elapsed if elapsed else 0.0
+        logging.info(f"{count}/{total} tasks, {self.stored} songs stored, "
+                     f"{self.skipped} skipped, {self.failed} failed, "
+                     f"{elapsed:.0f}s, {rate:.2f} songs/s")
+
+
+def read_songs(path):
+    """Reads (artist, song) pairs from a file of "artist, song" lines."""
+    pairs = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            artist_name, _, song_name = line.partition(',')
+            if song_name.strip():
+                pairs.append((artist_name.strip(), song_name.strip()))
+    return pairs
+
+
+def main(argv=None):
+    """Parses the command line and fills the song store."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--artists', nargs='*', default=[],
+                        help='artists whose most popular songs are fetched')
+    parser.add_argument('--artist-file',
+                        help='file with one artist per line')
+    parser.add_argument('--songs',
+                        help='file with one "artist, song" pair per line')
+    parser.add_argument('--max-songs', type=int, default=20,
+                        help='songs fetched per artist')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='fetches running at the same time')
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='Genius.com searches started per second')
+    parser.add_argument('--progress', default='prewarm.progress',
+                        help='file recording finished artists and songs')
+    parser.add_argument('--db', default=os.environ.get('SONG_DB', 'songs.db'),
+                        help='song store file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+
+    genius = geniusclient.PooledGenius(os.environ.get('GENIUS_TOKEN'),
+                                       pool_size=2 * args.workers)
+    prewarmer = Prewarmer(genius, songstore.SongStore(args.db),
+                          pipeline.TokenBucket(args.rate), args.progress)
+
+    artists = list(args.artists)
+    if args.artist_file:
+        with open(args.artist_file) as f:
+            artists.extend(line.strip() for line in f if line.strip())
+
+    tasks = [(prewarmer.warm_artist, (artist, args.max_songs))
+             for artist in artists]
+    if args.songs:
+        tasks.extend((prewarmer.warm_song, pair)
+                     for pair in read_songs(args.songs))
+    if not tasks:
+        parser.error('nothing to fetch, give --artists, --artist-file or --songs')
+
+    prewarmer.run(tasks, args.workers)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Module to pace replies by what reddit says the bot may do: the
+request quota reported with every api response, and the RATELIMIT
+errors telling how long to wait before commenting again.
+"""
+import re
+import time
+import logging
+import threading
+
+import metrics
+import pipeline
+
+
+# Matches the wait in messages like "you are doing that too much. try
+# again in 9 minutes." or "Take a break for 30 seconds before trying again."
+_WAIT = re.compile(r'(\d+)\s*(second|minute|hour)', re.IGNORECASE)
+
+_UNIT_SECONDS = {'second': 1, 'minute': 60, 'hour': 60 * 60}
+
+_RATELIMITED = metrics.counter('reply_ratelimited_total',
+                               'Replies reddit refused with a RATELIMIT error')
+_WAIT_SECONDS = metrics.histogram('reply_wait_seconds',
+                                  'Time replies waited for the scheduler',
+                                  buckets=(0.1, 1, 5, 10, 30, 60, 120, 300,
+                                           600, 1800, 3600))
+
+
+class RateLimited(Exception):
+    """Reddit refused a reply for now, it may be sent after wait seconds."""
+
+    def __init__(self, wait):
+        super().__init__(f"Rate limited for {wait:.0f} seconds")
+        self.wait = wait
+
+
+def ratelimit_wait(exception):
+    """Returns the seconds a RedditAPIException says to wait, or None if it isn't a RATELIMIT."""
+    for item in getattr(exception, 'items', ()):
+        if item.error_type != 'RATELIMIT':
+            continue
+        match = _WAIT.search(item.message or '')
+        if match is None:
+            # No hint, wait out the longest window reddit uses.
+            return 10 * 60
+        amount, unit = match.groups()
+        # The message rounds down, so wait one more unit.
+        return (int(amount) + 1) * _UNIT_SECONDS[unit.lower()]
+    return None
+
+
+class ReplyScheduler:
+    """
+    Lets replies through no faster than rate per second, with bursts of up
+    to burst replies, and slower whenever reddit asks for it.
+
+    limits, if given, returns the quota of the api client, such as praw's
+    reddit.auth.limits: a dict with the requests 'remaining' and the
+    'reset_timestamp' of the window. The requests left over reserve are
+    spread evenly over what is left of the window. A RATELIMIT error holds
+    back every reply until the wait it asked for is over.
+    """
+
+    def __init__(self, rate, burst=1, limits=None, reserve=10):
+        self.reserve = reserve
+        self._bucket = pipeline.TokenBucket(rate, burst)
+        self._limits = limits
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.ratelimited = 0
+
+    def block(self, seconds):
+        """Holds back every reply for seconds from now."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.time() + seconds)
+            self.ratelimited += 1
+        _RATELIMITED.inc()
+        logging.warning(f"Rate limited, holding replies for {seconds:.0f} seconds")
+
+    def _quota_wait(self):
+        """Returns the seconds to wait to stay within the api quota."""
+        if self._limits is None:
+            return 0.0
+        limits = self._limits() or {}
+        remaining = limits.get('remaining')
+        reset = limits.get('reset_timestamp')
+        if remaining is None or reset is None:
+            return 0.0
+        window = max(0.0, reset - time.time())
+        spare = remaining - self.reserve
+        if spare <= 0:
+            return window
+        return window / spare
+
+    def acquire(self):
+        """Blocks until a reply may be sent."""
+        start = time.monotonic()
+        self._bucket.acquire()
+        # Checked again after sleeping, another RATELIMIT may have come in.
+        while True:
+            with self._lock:
+                blocked = self._blocked_until - time.time()
+            if blocked <= 0:
+                break
+            time.sleep(blocked)
+        pace = self._quota_wait()
+        if pace > 0:
+            time.sleep(pace)
+        _WAIT_SECONDS.observe(time.monotonic() - start)
+
+    def stats(self):
+        """Returns how many replies were rate limited and for how long replies are held back."""
+        with self._lock:
+            blocked = max(0.0, self._blocked_until - time.time())
+        return {'ratelimited': self.ratelimited, 'blocked_for': blocked}
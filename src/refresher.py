@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Module to refresh stale songs in the background, so that replies
+keep being served from the stored copy while a new one is fetched.
+"""
+import queue
+import logging
+import threading
+
+import cache
+
+
+class Refresher:
+    """
+    Runs refresh(song_id) on a background thread for songs asked to be
+    refreshed, no more than rate times per second.
+
+    A song is queued once however many times it is asked for, and isn't
+    queued again for retry_after seconds after its refresh, so a song
+    Genius.com fails on isn't fetched over and over. When the queue is
+    full, requests are dropped, the song is asked for again on its next
+    reply.
+    """
+
+    def __init__(self, rate, maxsize=1000, retry_after=60 * 60):
+        self.rate = rate
+        self.maxsize = maxsize
+        self.requested = 0
+        self.refreshed = 0
+        self.failed = 0
+        self.dropped = 0
+        # Bounded by maxsize pending songs, so stop can always add its marker.
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._recent = cache.TTLCache(maxsize, retry_after)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self, refresh):
+        """Starts the background thread, refresh(song_id) refreshes one song."""
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, args=(refresh,),
+                                        name='refresher', daemon=True)
+        self._thread.start()
+
+    def request(self, song_id):
+        """Queues song_id to be refreshed without waiting, returns False if it wasn't queued."""
+        with self._lock:
+            if song_id in self._pending or song_id in self._recent:
+                return False
+            if len(self._pending) >= self.maxsize:
+                self.dropped += 1
+                return False
+            self._queue.put(song_id)
+            self._pending.add(song_id)
+            self.requested += 1
+        return True
+
+    def stop(self):
+        """Stops the background thread, songs still queued are left for the next start."""
+        self._stopping.set()
+        if self._thread is not None:
+            # Wakes the thread up if it is waiting for a song.
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, refresh):
+        """Refreshes queued songs one at a time, pacing them to the rate."""
+        while not self._stopping.is_set():
+            song_id = self._queue.get()
+            if song_id is None:
+                continue
+            try:
+                refresh(song_id)
+                self.refreshed += 1
+            except Exception:
+                self.failed += 1
+                logging.exception(f"Failed to refresh song {song_id}")
+            with self._lock:
+                self._pending.discard(song_id)
+                self._recent.add(song_id)
+            self._stopping.wait(1 / self.rate)
+
+    def stats(self):
+        """Returns the refresh counters and the number of songs waiting."""
+        with self._lock:
+            return {
+                'requested': self.requested,
+                'refreshed': self.refreshed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'pending': len(self._pending),
+            }
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Module to index song lyrics by section and bar, so a part of
+the lyrics can be looked up without searching the whole text.
+"""
+import re
+
+
+# Lyrics suboptions in the order their sections appear in a reply.
+SECTION_ORDER = ['intro', 'verse1', 'pre-chorus', 'chorus', 'post-chorus',
+                 'hook', 'refrain', 'collision', 'bridge', 'break',
+                 'interlude', 'verse2', 'verse3', 'verse4', 'verse5',
+                 'verse6', 'verse7', 'verse8', 'verse9', 'verse10',
+                 'verse11', 'verse12', 'verse13', 'outro']
+
+# Key of the index in the songs json file.
+INDEX_KEY = 'section_index'
+
+# Key of the version of the header parsing the saved index was built
+# with, bumped so indexes built by an older version are built again.
+INDEX_VERSION_KEY = 'section_index_version'
+INDEX_VERSION = 2
+
+# Section header such as "[Verse 2: Eminem]", captures "Verse 2: Eminem".
+_HEADER = re.compile(r'\[([^\]]+)')
+
+# What follows the section name in a header: the performers after a colon,
+# a spaced dash or in parentheses. A bare dash belongs to names like
+# "Pre-Chorus".
+_SEPARATOR = re.compile(r':|\(|\s[-\u2013\u2014]|[-\u2013\u2014]\s')
+
+# Repeat markers such as "x2" or "2x", which don't number the section.
+_REPEAT = re.compile(r'\b(?:x\s*\d+|\d+\s*x)\b')
+
+# Section label up to its number, like "verse 2" or "verse2".
+_NUMBERED = re.compile(r'(.*?)\s*(\d+)\b')
+
+
+def _split_label(name):
+    """Splits a section name such as 'Verse 2 - Eminem' into its label and number."""
+    name = _SEPARATOR.split(name.lower(), 1)[0]
+    name = _REPEAT.sub('', name).strip()
+    numbered = _NUMBERED.match(name)
+    if numbered:
+        return numbered.group(1).replace(' ', ''), int(numbered.group(2))
+    return name.replace(' ', ''), None
+
+
+def build_index(lyrics):
+    """
+    Builds the section index of the lyrics.
+
+    The index maps a section label ('verse', 'chorus', ...) to its ordinal
+    (as a string, so the index survives a round trip through json) and the
+    ordinal to the sections bars. The first bar is the section header.
+    """
+    index = {}
+    for stanza in lyrics.split('\n\n'):
+        bars = stanza.strip('\n').split('\n')
+        header = _HEADER.match(bars[0].strip())
+        if not header:
+            continue
+        label, ordinal = _split_label(header.group(1))
+        ordinals = index.setdefault(label, {})
+        if ordinal is None:
+            ordinal = len(ordinals) + 1
+        ordinals.setdefault(str(ordinal), bars)
+    return index
+
+
+def get_index(data):
+    """Returns the section index of a parsed song, building it if it wasn't saved."""
+    index = data.get(INDEX_KEY)
+    if index is None or data.get(INDEX_VERSION_KEY) != INDEX_VERSION:
+        index = add_index(data)[INDEX_KEY]
+    return index
+
+
+def add_index(data):
+    """Adds a freshly built section index to a parsed song."""
+    data[INDEX_KEY] = build_index(data.get('lyrics') or '')
+    data[INDEX_VERSION_KEY] = INDEX_VERSION
+    return data
+
+
+def lookup(index, suboption):
+    """Returns the bars of the section named by a lyrics suboption."""
+    label, ordinal = _split_label(suboption)
+    ordinals = index.get(label)
+    if not ordinals:
+        return None
+    if ordinal is None:
+        return ordinals[min(ordinals, key=int)]
+    return ordinals.get(str(ordinal))
+
+
+def render(index, suboptions, beg=None, end=None):
+    """
+    Returns the requested sections of the lyrics in reply order.
+
+    When beg is given, verses are cut down to bars beg through end (or
+    through the last bar when end is None), keeping the verses header.
+    """
+    stop = None if end is None else end + 1
+
+    parts = []
+    for suboption in SECTION_ORDER:
+        if suboption not in suboptions:
+            continue
+        bars = lookup(index, suboption)
+        if bars is None:
+            continue
+        if beg is not None and suboption.startswith('verse'):
+            parts.append(bars[0] + ' ' + '\n\n'.join(bars[beg:stop]))
+        else:
+            parts.append('\n'.join(bars))
+    return '\n\n'.join(parts)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Module to coalesce concurrent calls for the same key into a
+single call whose result is shared by every caller.
+"""
+import threading
+
+
+class _Call:
+    """A call in flight and the result it ended with."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time.
+
+    Callers asking for a key while its call is in flight wait for it and
+    receive the same result, or the same exception.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.saved = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Returns func(), or the result of the call already running for key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.saved += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """Returns how many calls ran and how many were saved by waiting on one."""
+        return {'calls': self.calls, 'saved': self.saved}
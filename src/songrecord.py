@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Module with the slim song record the replies are rendered from:
+just the fields the replies use, out of the whole Genius.com json,
+with a compact binary form for the song store.
+"""
+import marshal
+
+import sections
+
+
+# Bumped whenever the fields or the section index change, so records
+# packed by an older version are projected again from the stored json.
+FORMAT = 2
+
+
+class SongRecord:
+    """
+    The fields of a song the replies are rendered from.
+
+    Artists are tuples of names. custom_performances holds (label,
+    artist names) pairs and song_relationships (type, song full titles)
+    pairs, in Genius.com order.
+    """
+
+    __slots__ = ('id', 'title', 'lyrics', 'primary_artist', 'featured_artists',
+                 'album', 'release_date', 'description', 'producer_artists',
+                 'writer_artists', 'custom_performances', 'recording_location',
+                 'song_relationships', 'section_index')
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Projects a songs json onto a record."""
+        album = data.get('album')
+        description = (data.get('description') or {}).get('plain', '')
+        return cls(
+            data.get('id'),
+            data.get('title'),
+            data.get('lyrics', 'Lyrics Unavailable'),
+            (data.get('primary_artist') or {}).get('name'),
+            _names(data.get('featured_artists')),
+            album.get('name', '') if isinstance(album, dict) else '',
+            data.get('release_date_for_display') or '',
+            '' if description == '?' else description,
+            _names(data.get('producer_artists')),
+            _names(data.get('writer_artists')),
+            tuple((performance.get('label'), _names(performance.get('artists')))
+                  for performance in data.get('custom_performances') or ()),
+            data.get('recording_location') or '',
+            tuple((relationship.get('type'),
+                   tuple(song.get('full_title')
+                         for song in relationship.get('songs') or ()))
+                  for relationship in data.get('song_relationships') or ()),
+            sections.get_index(data),
+        )
+
+    def pack(self):
+        """Returns the record as bytes."""
+        return marshal.dumps((FORMAT, tuple(getattr(self, name)
+                                            for name in self.__slots__)))
+
+    @classmethod
+    def unpack(cls, blob):
+        """Rebuilds a record from pack()'s bytes, or returns None if they are of another format."""
+        try:
+            version, values = marshal.loads(blob)
+        except (EOFError, ValueError, TypeError):
+            return None
+        if version != FORMAT:
+            return None
+        return cls(*values)
+
+
+def _names(artists):
+    """Returns the names of a list of Genius.com artists."""
+    return tuple(artist.get('name') for artist in artists or ())
@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""
+Module to store fetched songs in a local sqlite database, keyed
+by artist and song name as well as by genius song id.
+
+Songs are stored zlib compressed. The store can be kept under a byte
+budget by calling maintain() in the background, which evicts the songs
+requested least recently.
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+
+import names
+import sections
+import songrecord
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    song_id INTEGER PRIMARY KEY,
+    artist_key TEXT NOT NULL,
+    title_key TEXT NOT NULL,
+    artist TEXT,
+    title TEXT,
+    data BLOB NOT NULL,
+    updated_at REAL NOT NULL,
+    record BLOB,
+    size INTEGER,
+    accessed_at REAL
+);
+DROP INDEX IF EXISTS songs_artist_title;
+CREATE INDEX IF NOT EXISTS songs_artist ON songs (artist_key);
+
+CREATE TABLE IF NOT EXISTS aliases (
+    artist_key TEXT NOT NULL,
+    title_key TEXT NOT NULL,
+    song_id INTEGER NOT NULL,
+    PRIMARY KEY (artist_key, title_key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS aliases_song ON aliases (song_id);
+"""
+
+# Columns added after the songs table was first released, with the value
+# they get on songs stored before.
+_COLUMNS = (
+    ('record', 'BLOB', None),
+    ('size', 'INTEGER', 'length(data) + ifnull(length(record), 0)'),
+    ('accessed_at', 'REAL', 'updated_at'),
+)
+
+_SONG_COLUMNS = ('song_id, artist_key, title_key, artist, title, data, '
+                 'updated_at, record, size, accessed_at')
+
+COMPRESS_LEVEL = 6
+
+
+def _compress(payload):
+    """Compresses a str or bytes payload."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return zlib.compress(payload, COMPRESS_LEVEL)
+
+
+def _decompress(blob):
+    """Returns the bytes of a stored payload, which older versions stored uncompressed."""
+    if isinstance(blob, str):
+        return blob.encode()
+    try:
+        return zlib.decompress(blob)
+    except zlib.error:
+        return blob
+
+
+def song_key(artist_name, song_name):
+    """Normalizes artist and song name into the key songs are looked up by."""
+    return names.normalize(artist_name), names.normalize(song_name)
+
+
+def canonical_key(data):
+    """Returns the key of the artist and title Genius.com gives the song."""
+    artist = (data.get('primary_artist') or {}).get('name') or ''
+    return song_key(artist, data.get('title') or '')
+
+
+class SongStore:
+    """Songs json, stored in one sqlite file.
+
+    Songs are stored under the key of their Genius.com artist and title, and
+    every other key they were requested by is kept as an alias. Each thread
+    gets its own connection, so the store can be shared by the fetch and
+    render workers.
+    """
+
+    def __init__(self, path='songs.db', fuzzy_threshold=0.9):
+        self.path = path
+        self.fuzzy_threshold = fuzzy_threshold
+        self._local = threading.local()
+        self._artists = None
+        self._artists_lock = threading.Lock()
+        # Song id -> when it was last requested, written by maintain().
+        self._accessed = {}
+        self._accessed_lock = threading.Lock()
+        self.evicted = 0
+        self._conn().executescript(_SCHEMA)
+        self._add_columns()
+        self._backfill_aliases()
+
+    def _conn(self):
+        """Returns the connection of the calling thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            # Only takes effect on a new file, before WAL writes its
+            # header, so maintain() can give freed pages back.
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _add_columns(self):
+        """Adds the columns stores created before them lack, records are packed on first load."""
+        conn = self._conn()
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(songs)')]
+        with conn:
+            for name, kind, value in _COLUMNS:
+                if name in columns:
+                    continue
+                conn.execute(f"ALTER TABLE songs ADD COLUMN {name} {kind}")
+                if value is not None:
+                    conn.execute(f"UPDATE songs SET {name} = {value}")
+            conn.execute('CREATE INDEX IF NOT EXISTS songs_accessed '
+                         'ON songs (accessed_at)')
+
+    def _backfill_aliases(self):
+        """Adds aliases for songs stored before there were any."""
+        conn = self._conn()
+        if conn.execute('SELECT 1 FROM aliases LIMIT 1').fetchone():
+            return
+        rows = conn.execute(
+            'SELECT song_id, artist_key, title_key, artist, title FROM songs').fetchall()
+        aliases = []
+        for song_id, artist_key, title_key, artist, title in rows:
+            aliases.append((artist_key, title_key, song_id))
+            aliases.append(song_key(artist or '', title or '') + (song_id,))
+        with conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO aliases (artist_key, title_key, song_id) '
+                'VALUES (?, ?, ?)', aliases)
+
+    def find(self, artist_key, title_key):
+        """Returns (song_id, updated_at) of the song stored under the key or alias, or None."""
+        found = self._conn().execute(
+            'SELECT songs.song_id, songs.updated_at FROM aliases '
+            'JOIN songs ON songs.song_id = aliases.song_id '
+            'WHERE aliases.artist_key = ? AND aliases.title_key = ?',
+            (artist_key, title_key)).fetchone()
+        if found is not None:
+            # Kept in memory, the next maintain() writes it.
+            with self._accessed_lock:
+                self._accessed[found[0]] = time.time()
+        return found
+
+    def closest(self, artist_key, title_key):
+        """
+        Returns (song_id, updated_at) of the song stored under a nearly
+        identical spelling of the key, or None.
+
+        The artist and then the title are matched against the stored ones,
+        artists sharing a trigram with the key being the candidates. The
+        match isn't remembered, a distinct song can look alike, so the
+        caller adds the alias once Genius.com confirms it is the same song.
+        """
+        artist = artist_key
+        if not self._conn().execute(
+                'SELECT 1 FROM aliases WHERE artist_key = ? LIMIT 1',
+                (artist_key,)).fetchone():
+            artist = names.closest(artist_key, self._artist_candidates(artist_key),
+                                   self.fuzzy_threshold)
+            if artist is None:
+                return None
+
+        titles = [row[0] for row in self._conn().execute(
+            'SELECT title_key FROM aliases WHERE artist_key = ?', (artist,))]
+        title = names.closest(title_key, titles, self.fuzzy_threshold)
+        if title is None:
+            return None
+
+        return self.find(artist, title)
+
+    def add_alias(self, artist_key, title_key, song_id):
+        """Remembers another key the song is requested by."""
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO aliases (artist_key, title_key, song_id) '
+                'VALUES (?, ?, ?)', (artist_key, title_key, song_id))
+        self._index_artist(artist_key)
+
+    def load(self, song_id):
+        """Returns the parsed json of the song."""
+        row = self._conn().execute(
+            'SELECT data FROM songs WHERE song_id = ?', (song_id,)).fetchone()
+        if row is None:
+            raise KeyError(song_id)
+        return json.loads(_decompress(row[0]))
+
+    def load_record(self, song_id):
+        """
+        Returns the SongRecord of the song.
+
+        Records missing or packed in an older format are projected from the
+        json again and stored, so the json is parsed once per song.
+        """
+        row = self._conn().execute(
+            'SELECT record FROM songs WHERE song_id = ?', (song_id,)).fetchone()
+        if row is None:
+            raise KeyError(song_id)
+        record = songrecord.SongRecord.unpack(_decompress(row[0])) if row[0] else None
+        if record is None:
+            record = songrecord.SongRecord.from_dict(self.load(song_id))
+            with self._conn() as conn:
+                blob = _compress(record.pack())
+                conn.execute('UPDATE songs SET record = ?, size = length(data) + ? '
+                             'WHERE song_id = ?', (blob, len(blob), song_id))
+        return record
+
+    def names(self, song_id):
+        """Returns the Genius.com (artist, title) of the song, or None if it isn't stored."""
+        return self._conn().execute(
+            'SELECT artist, title FROM songs WHERE song_id = ?', (song_id,)).fetchone()
+
+    def put(self, artist_key, title_key, data):
+        """Stores the songs json with the key as an alias, returns (song_id, updated_at)."""
+        updated_at = time.time()
+        row = self._row(data, updated_at)
+        aliases = [(artist_key, title_key, data['id']),
+                   (row[1], row[2], data['id'])]
+        with self._conn() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO songs ({_SONG_COLUMNS}) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            conn.executemany(
+                'INSERT OR REPLACE INTO aliases (artist_key, title_key, song_id) '
+                'VALUES (?, ?, ?)', aliases)
+        for alias in aliases:
+            self._index_artist(alias[0])
+        return data['id'], updated_at
+
+    def by_artist(self, artist_key):
+        """Returns (song_id, title) of every stored song by the artist."""
+        return self._conn().execute(
+            'SELECT song_id, title FROM songs WHERE artist_key = ? '
+            'ORDER BY title', (artist_key,)).fetchall()
+
+    def import_dir(self, directory='lyrics'):
+        """Imports every lyrics_<artist>_<song>.json file of the directory, returns the count."""
+        updated_at = time.time()
+        rows = []
+        aliases = []
+        for filename in os.listdir(directory):
+            if not (filename.startswith('lyrics_') and filename.endswith('.json')):
+                continue
+            try:
+                artist_name, song_name = filename[7:-5].split('_', 1)
+                with open(os.path.join(directory, filename)) as f:
+                    data = json.load(f)
+                sections.get_index(data)
+                row = self._row(data, updated_at)
+            except (ValueError, KeyError):
+                logging.warning(f"Skipping {filename}")
+                continue
+            rows.append(row)
+            aliases.append(song_key(artist_name, song_name) + (data['id'],))
+            aliases.append((row[1], row[2], data['id']))
+
+        with self._conn() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO songs ({_SONG_COLUMNS}) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.executemany(
+                'INSERT OR REPLACE INTO aliases (artist_key, title_key, song_id) '
+                'VALUES (?, ?, ?)', aliases)
+        with self._artists_lock:
+            self._artists = None
+        return len(rows)
+
+    def maintain(self, max_bytes=None, batch_size=100, min_idle=10 * 60):
+        """
+        Runs one round of upkeep and returns what it did.
+
+        Writes the request times gathered since the last round, compresses
+        a batch of songs stored uncompressed by older versions, evicts the
+        songs requested least recently, batch_size at a time, while the
+        songs take more than max_bytes, and gives freed pages back to the
+        file system. Meant to be called from a background thread, every
+        step is its own short transaction.
+
+        Songs requested in the last min_idle seconds are never evicted, a
+        request may still be on its way from fetching the song to rendering
+        it. min_idle should be longer than the interval between rounds, as
+        other processes sharing the store write their request times then.
+        """
+        done = {'touched': self._write_accesses(),
+                'compressed': self._compress_batch(batch_size),
+                'evicted': 0, 'vacuumed': 0}
+        while max_bytes and self.size() > max_bytes:
+            evicted = self._evict_batch(batch_size, time.time() - min_idle)
+            if not evicted:
+                break
+            done['evicted'] += evicted
+        done['vacuumed'] = self._vacuum(batch_size * 10)
+        return done
+
+    def size(self):
+        """Returns the bytes taken by the stored songs."""
+        return self._conn().execute(
+            'SELECT ifnull(sum(size), 0) FROM songs').fetchone()[0]
+
+    def stats(self):
+        """Returns the number of songs, their bytes, the file size and the songs evicted."""
+        conn = self._conn()
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        return {
+            'songs': conn.execute('SELECT count(*) FROM songs').fetchone()[0],
+            'bytes': self.size(),
+            'file_bytes': page_count * page_size,
+            'evicted': self.evicted,
+        }
+
+    def _write_accesses(self):
+        """Writes the request times gathered in memory, returns how many."""
+        with self._accessed_lock:
+            accessed, self._accessed = self._accessed, {}
+        if accessed:
+            with self._conn() as conn:
+                conn.executemany(
+                    'UPDATE songs SET accessed_at = ? WHERE song_id = ?',
+                    [(at, song_id) for song_id, at in accessed.items()])
+        return len(accessed)
+
+    def _compress_batch(self, batch_size):
+        """Compresses up to batch_size songs stored as text, returns how many."""
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT song_id, data FROM songs WHERE typeof(data) = 'text' "
+            "LIMIT ?", (batch_size,)).fetchall()
+        if not rows:
+            return 0
+        updates = []
+        for song_id, data in rows:
+            blob = _compress(data)
+            # The record is packed again, compressed, on its next load.
+            updates.append((blob, len(blob), song_id))
+        with conn:
+            conn.executemany(
+                'UPDATE songs SET data = ?, record = NULL, size = ? '
+                'WHERE song_id = ?', updates)
+        return len(rows)
+
+    def _evict_batch(self, batch_size, before):
+        """Deletes the batch_size songs requested least recently, all before before, returns how many."""
+        conn = self._conn()
+        with self._accessed_lock:
+            # Requested since the request times were last written.
+            recent = set(self._accessed)
+        song_ids = [row[0] for row in conn.execute(
+            'SELECT song_id FROM songs WHERE accessed_at < ? '
+            'ORDER BY accessed_at LIMIT ?', (before, batch_size + len(recent)))
+            if row[0] not in recent][:batch_size]
+        if not song_ids:
+            return 0
+        marks = ', '.join('?' * len(song_ids))
+        with conn:
+            conn.execute(f"DELETE FROM aliases WHERE song_id IN ({marks})", song_ids)
+            conn.execute(f"DELETE FROM songs WHERE song_id IN ({marks})", song_ids)
+        # The artist index is rebuilt from the aliases that are left.
+        with self._artists_lock:
+            self._artists = None
+        self.evicted += len(song_ids)
+        logging.info(f"Evicted {len(song_ids)} songs from the song store")
+        return len(song_ids)
+
+    def _vacuum(self, pages):
+        """Gives up to pages free pages back to the file system, returns how many were free."""
+        conn = self._conn()
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return 0
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if free:
+            # A cursor frees a single page, executescript runs it through.
+            conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        return min(free, pages)
+
+    def _artist_candidates(self, artist_key):
+        """Returns the known artist keys sharing a trigram with artist_key."""
+        with self._artists_lock:
+            if self._artists is None:
+                self._artists = {}
+                for row in self._conn().execute(
+                        'SELECT DISTINCT artist_key FROM aliases'):
+                    self._add_artist(row[0])
+            candidates = set()
+            for gram in names.trigrams(artist_key):
+                candidates.update(self._artists.get(gram, ()))
+            return candidates
+
+    def _index_artist(self, artist_key):
+        """Adds an artist key to the trigram index, if the index was built."""
+        with self._artists_lock:
+            if self._artists is not None:
+                self._add_artist(artist_key)
+
+    def _add_artist(self, artist_key):
+        """Files an artist key under each of its trigrams."""
+        for gram in names.trigrams(artist_key):
+            self._artists.setdefault(gram, set()).add(artist_key)
+
+    @staticmethod
+    def _row(data, updated_at):
+        """Builds the songs table row of a song."""
+        artist_key, title_key = canonical_key(data)
+        artist = (data.get('primary_artist') or {}).get('name')
+        blob = _compress(json.dumps(data))
+        record = _compress(songrecord.SongRecord.from_dict(data).pack())
+        return (data['id'], artist_key, title_key, artist, data.get('title'),
+                blob, updated_at, record, len(blob) + len(record), updated_at)
+
+
+if __name__ == "__main__":
+    # Usage: python songstore.py [lyrics directory] [database file]
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'lyrics'
+    path = sys.argv[2] if len(sys.argv) > 2 else os.environ.get('SONG_DB', 'songs.db')
+    count = SongStore(path).import_dir(directory)
+    print(f"Imported {count} songs from {directory} into {path}")
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Module to keep parsed song requests in a local sqlite queue until
+they are replied, so that a crash or a restart doesn't lose them.
+
+A job is pending until a worker takes it, then running until the worker
+reports it done or failed. A failed job goes back to pending after a
+backoff, until it runs out of attempts.
+"""
+import sys
+import json
+import time
+import sqlite3
+import threading
+
+import backoff
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY,
+    cid TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL,
+    enqueued_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, not_before);
+"""
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    """A queued request: its comment id, payload dict and attempts so far."""
+
+    def __init__(self, job_id, cid, payload, attempts):
+        self.job_id = job_id
+        self.cid = cid
+        self.payload = payload
+        self.attempts = attempts
+
+
+class WorkQueue:
+    """Jobs keyed by comment id, stored in one sqlite file.
+
+    Each comment is queued once, whatever number of times it is put. Each
+    thread gets its own connection, so ingestion and the reply workers can
+    share the queue.
+    """
+
+    def __init__(self, path='queue.db', max_attempts=5, retry_base=5.0,
+                 retry_cap=600.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._retry = backoff.Backoff(retry_base, retry_cap)
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self):
+        """Returns the connection of the calling thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def put(self, cid, payload):
+        """Queues payload for comment cid, returns False if it was queued before."""
+        now = time.time()
+        cursor = self._conn().execute(
+            'INSERT OR IGNORE INTO jobs (cid, payload, status, not_before, '
+            'enqueued_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (cid, json.dumps(payload), PENDING, now, now, now))
+        return cursor.rowcount == 1
+
+    def get(self):
+        """Takes the oldest pending job that is due and marks it running, or returns None."""
+        conn = self._conn()
+        now = time.time()
+        # The write lock is taken up front, so two workers never take the same job.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT job_id, cid, payload, attempts FROM jobs '
+                'WHERE status = ? AND not_before <= ? '
+                'ORDER BY not_before LIMIT 1', (PENDING, now)).fetchone()
+            if row is not None:
+                conn.execute(
+                    'UPDATE jobs SET status = ?, attempts = attempts + 1, '
+                    'updated_at = ? WHERE job_id = ?', (RUNNING, now, row[0]))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        job_id, cid, payload, attempts = row
+        return Job(job_id, cid, json.loads(payload), attempts + 1)
+
+    def done(self, job):
+        """Marks the job done."""
+        self._set(job.job_id, DONE, time.time(), None)
+
+    def retry(self, job, error):
+        """
+        Puts the job back after a backoff, or marks it failed once it has
+        used up its attempts. Returns True if it will be retried.
+        """
+        now = time.time()
+        if job.attempts >= self.max_attempts:
+            self._set(job.job_id, FAILED, now, str(error))
+            return False
+        self._set(job.job_id, PENDING,
+                  now + self._retry.delay(job.attempts - 1), str(error))
+        return True
+
+    def defer(self, job, delay, reason):
+        """Puts the job back for delay seconds without using up one of its attempts."""
+        now = time.time()
+        self._conn().execute(
+            'UPDATE jobs SET status = ?, attempts = attempts - 1, not_before = ?, '
+            'updated_at = ?, error = ? WHERE job_id = ?',
+            (PENDING, now + delay, now, reason, job.job_id))
+
+    def _set(self, job_id, status, not_before, error):
+        self._conn().execute(
+            'UPDATE jobs SET status = ?, not_before = ?, updated_at = ?, '
+            'error = ? WHERE job_id = ?',
+            (status, not_before, time.time(), error, job_id))
+
+    def recover(self):
+        """Puts back the jobs left running by a process that stopped, returns how many."""
+        now = time.time()
+        return self._conn().execute(
+            'UPDATE jobs SET status = ?, not_before = ?, updated_at = ? '
+            'WHERE status = ?', (PENDING, now, now, RUNNING)).rowcount
+
+    def purge(self, age):
+        """Deletes the jobs that were done or failed more than age seconds ago."""
+        return self._conn().execute(
+            'DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?',
+            (DONE, FAILED, time.time() - age)).rowcount
+
+    def depth(self):
+        """Returns the number of jobs per status."""
+        return dict(self._conn().execute(
+            'SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def oldest_age(self):
+        """Returns the age in seconds of the oldest job still waiting for a reply."""
+        oldest = self._conn().execute(
+            'SELECT MIN(enqueued_at) FROM jobs WHERE status IN (?, ?)',
+            (PENDING, RUNNING)).fetchone()[0]
+        return time.time() - oldest if oldest is not None else 0.0
+
+    def stats(self):
+        """Returns the number of jobs per status and the age of the oldest waiting job."""
+        stats = {status: 0 for status in (PENDING, RUNNING, DONE, FAILED)}
+        stats.update(self.depth())
+        stats['oldest_age'] = self.oldest_age()
+        return stats
+
+
+if __name__ == "__main__":
+    # Prints the backlog of a queue file, e.g. python workqueue.py queue.db
+    queue = WorkQueue(sys.argv[1] if len(sys.argv) > 1 else 'queue.db')
+    for name, value in queue.stats().items():
+        print(f"{name}: {value}")
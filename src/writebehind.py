@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Module to buffer writes in memory and flush them to the
+database in batches from a background thread.
+"""
+import time
+import logging
+import threading
+
+import metrics
+
+
+_FLUSH_SECONDS = metrics.histogram('flush_seconds',
+                                   'Time spent flushing a write-behind batch')
+_FLUSH_SIZE = metrics.histogram('flush_size', 'Items per write-behind batch',
+                                buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+
+class WriteBehindBuffer:
+    """Collects items and hands them to flush_func in batches.
+
+    A batch is flushed once max_size items are waiting, once the oldest item
+    has waited max_age seconds, or when the buffer is closed. Items stay
+    visible through `in` until flush_func has stored them.
+    """
+
+    def __init__(self, flush_func, max_size=50, max_age=5.0, name='buffer'):
+        self.flush_func = flush_func
+        self.max_size = max_size
+        self.max_age = max_age
+        self.name = name
+        self._pending = []
+        self._inflight = set()
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+        # Flush latency, so the batch size can be tuned.
+        self.flushes = 0
+        self.flushed_items = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    def start(self):
+        """Starts the background flushing thread."""
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name=f"{self.name}-flush",
+                                        daemon=True)
+        self._thread.start()
+
+    def add(self, item):
+        """Queues item for the next batch."""
+        with self._cond:
+            first = not self._pending
+            if first:
+                self._oldest = time.monotonic()
+            self._pending.append(item)
+            # The first item starts the max_age timer of the waiting thread.
+            if first or len(self._pending) >= self.max_size:
+                self._cond.notify()
+
+    def __contains__(self, item):
+        with self._cond:
+            return item in self._inflight or item in self._pending
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending) + len(self._inflight)
+
+    def flush(self):
+        """Writes every waiting item in one batch."""
+        with self._flush_lock:
+            with self._cond:
+                batch = self._pending
+                self._pending = []
+                self._oldest = None
+                self._inflight.update(batch)
+            if not batch:
+                return
+
+            start = time.monotonic()
+            try:
+                self.flush_func(batch)
+            except Exception:
+                logging.exception(f"Failed to flush {self.name}")
+                # Put the batch back so the next flush retries it.
+                with self._cond:
+                    self._pending[:0] = batch
+                    self._oldest = time.monotonic()
+                    self._inflight.difference_update(batch)
+                return
+            latency = time.monotonic() - start
+
+            with self._cond:
+                self._inflight.difference_update(batch)
+            self.flushes += 1
+            self.flushed_items += len(batch)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.total_flush_latency += latency
+            _FLUSH_SECONDS.labels(buffer=self.name).observe(latency)
+            _FLUSH_SIZE.labels(buffer=self.name).observe(len(batch))
+            logging.info(f"Flushed {len(batch)} items from {self.name} "
+                         f"in {latency * 1000:.1f} ms")
+
+    def stats(self):
+        """Returns the flush counters and latencies in seconds."""
+        average = self.total_flush_latency / self.flushes if self.flushes else 0.0
+        return {
+            'flushes': self.flushes,
+            'flushed_items': self.flushed_items,
+            'pending': len(self),
+            'last_flush_latency': self.last_flush_latency,
+            'avg_flush_latency': average,
+            'max_flush_latency': self.max_flush_latency,
+        }
+
+    def close(self):
+        """Stops the background thread and flushes what is left."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _due(self):
+        """Tells whether the waiting items should be flushed now."""
+        if not self._pending:
+            return False
+        if len(self._pending) >= self.max_size:
+            return True
+        return time.monotonic() - self._oldest >= self.max_age
+
+    def _run(self):
+        """Background loop flushing batches as they become due."""
+        while True:
+            with self._cond:
+                while not self._closed and not self._due():
+                    if self._pending:
+                        timeout = self.max_age - (time.monotonic() - self._oldest)
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+            self.flush()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import writebehind
+
+
+class WriteBehindBufferTest(unittest.TestCase):
+
+    def test_flushes_one_item_after_max_age(self):
+        batches = []
+        buffer = writebehind.WriteBehindBuffer(batches.append, max_size=20,
+                                               max_age=0.2, name='test')
+        buffer.start()
+        try:
+            buffer.add('a')
+            deadline = time.monotonic() + 2
+            while not batches and time.monotonic() < deadline:
+                time.sleep(0.02)
+            self.assertEqual(batches, [['a']])
+            self.assertNotIn('a', buffer)
+        finally:
+            buffer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()